@@ -1,7 +1,13 @@
 import asyncio
-from time import time
+from asyncio import ensure_future as create_task
+from collections import deque
 from uuid import uuid4
 
+# Throttler priority lanes, lower is served first.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
 class Throttler:
     """Generic asynchronous function object, useful for any kind of
     throttling.
@@ -9,19 +15,59 @@ class Throttler:
     Run is registered (and throttled if necessary) upon call of the created
     function object.
 
+    By default at most `ts_count` runs are permitted in any sliding window of
+    `tlim_s` seconds. If `burst` is given, a token bucket is used instead:
+    tokens refill at the rate of `ts_count` per `tlim_s` up to `burst`
+    tokens, each run taking one.
+
+    Callers that have to wait are queued per priority lane and released by a
+    single timer, so waiting callers don't hold any lock and each call costs
+    O(1) amortized. Higher priority lanes are served first and callers of a
+    lane in FIFO order. Capacity reserved for a lane can only be used by it
+    and the lanes above it. A caller that has waited for `max_wait_s` is
+    served next regardless of its lane and reservations.
+
     Parameters
     ----------
     ts_count : int
         Maximum number of times to run in the `tlim_s` time limit.
     tlim_s : float
         Time limit in seconds in which `ts_count` amount of runs are permitted.
+    burst : int
+        Token bucket capacity, None for a sliding window.
+    num_lanes : int
+        Number of priority lanes, the default lanes being PRIORITY_*.
+    reserved : dict
+        Lane -> number of runs (tokens with `burst`) kept for that lane and
+        the lanes above it.
+    max_wait_s : float
+        Starvation limit, None to always serve by priority.
     """
 
-    def __init__(self, ts_count, tlim_s, pub_sock=None, pub_tag=None):
-        self._timestamps = []
-        self._lock = asyncio.Lock()
+    def __init__(self, ts_count, tlim_s, pub_sock=None, pub_tag=None,
+                 burst=None, num_lanes=3, reserved=None, max_wait_s=None):
         self._ts_count = ts_count
         self._tlim_s = tlim_s
+        self._burst = burst
+        self._max_wait_s = max_wait_s
+        # runs that must remain available after a run of each lane
+        reserved = reserved or {}
+        self._headroom = [sum(reserved.get(i, 0) for i in range(lane))
+                          for lane in range(num_lanes)]
+        capacity = ts_count if burst is None else burst
+        if self._headroom[-1] >= capacity:
+            raise ValueError("reserved capacity leaves none for lowest lane")
+        if burst is None:
+            # times of the runs in the current window, oldest first
+            self._timestamps = deque()
+        else:
+            self._rate = ts_count / tlim_s
+            self._tokens = burst
+            self._last_refill = None
+        # per lane: deque of (deadline, future)
+        self._waiters = [deque() for _ in range(num_lanes)]
+        self._num_waiting = 0
+        self._timer = None
         self._pub_sock = pub_sock
         if not pub_tag:
             pub_tag = "throttler-" + str(uuid4())
@@ -33,25 +79,106 @@ class Throttler:
         if self._pub_sock:
             self._pub_sock.close()
 
-    async def _do_throttle(self):
-        now = time()
-        if len(self._timestamps) >= self._ts_count:
-            self._timestamps = [x for x in self._timestamps
-                                if now - x < self._tlim_s]
-            if len(self._timestamps) >= self._ts_count:
-                sleep_s = self._tlim_s - (now - self._timestamps[0])
-                # L.debug("throttler going to sleep ...")
-                if self._pub_sock:
-                    await self._pub_sock.send_multipart(
-                            [self._pub_tag, str(sleep_s).encode()])
-                await asyncio.sleep(sleep_s)
-                # L.debug("throttler woke up")
-                self._timestamps = self._timestamps[1:] + [time()]
-            else:
-                self._timestamps.append(now)
-        else:
+    def _get_delay(self, now, headroom=0):
+        """Return seconds until a run leaving headroom is permitted, 0 if
+        permitted now."""
+        if self._burst is None:
+            timestamps = self._timestamps
+            while timestamps and now - timestamps[0] >= self._tlim_s:
+                timestamps.popleft()
+            excess = len(timestamps) - (self._ts_count - headroom - 1)
+            if excess <= 0:
+                return 0
+            return timestamps[excess - 1] + self._tlim_s - now
+        if self._last_refill is not None:
+            elapsed = now - self._last_refill
+            self._tokens = min(self._burst,
+                               self._tokens + elapsed * self._rate)
+        self._last_refill = now
+        if self._tokens >= 1 + headroom:
+            return 0
+        return (1 + headroom - self._tokens) / self._rate
+
+    def _register(self, now):
+        if self._burst is None:
             self._timestamps.append(now)
+        else:
+            self._tokens -= 1
 
-    async def __call__(self):
-        async with self._lock:
-            await self._do_throttle()
+    def _notify(self, sleep_s):
+        if self._pub_sock:
+            create_task(self._pub_sock.send_multipart(
+                    [self._pub_tag, str(sleep_s).encode()]))
+
+    def _next_waiter(self, now):
+        """Return (lane, deadline) of the waiter to serve next, the longest
+        overdue one if any."""
+        first = None
+        overdue = None
+        for lane, waiters in enumerate(self._waiters):
+            while waiters and waiters[0][1].done():
+                # cancelled while waiting
+                waiters.popleft()
+                self._num_waiting -= 1
+            if not waiters:
+                continue
+            deadline = waiters[0][0]
+            if deadline is not None and deadline <= now:
+                if overdue is None or deadline < overdue[1]:
+                    overdue = lane, deadline
+            elif first is None:
+                first = lane, deadline
+        return overdue or first
+
+    def _next_deadline(self, now):
+        deadlines = [w[0][0] for w in self._waiters
+                     if w and w[0][0] is not None and w[0][0] > now]
+        return min(deadlines) if deadlines else None
+
+    def _dispatch(self, notify=True):
+        self._timer = None
+        loop = asyncio.get_event_loop()
+        while self._num_waiting:
+            now = loop.time()
+            picked = self._next_waiter(now)
+            if picked is None:
+                return
+            lane, deadline = picked
+            if deadline is not None and deadline <= now:
+                headroom = 0
+            else:
+                headroom = self._headroom[lane]
+            sleep_s = self._get_delay(now, headroom)
+            if sleep_s > 0:
+                deadline = self._next_deadline(now)
+                if deadline is not None and deadline - now < sleep_s:
+                    # wake up for a starving waiter
+                    sleep_s = deadline - now
+                self._timer = loop.call_later(sleep_s, self._dispatch)
+                if notify:
+                    self._notify(sleep_s)
+                return
+            self._register(now)
+            self._num_waiting -= 1
+            self._waiters[lane].popleft()[1].set_result(None)
+
+    async def __call__(self, priority=PRIORITY_NORMAL):
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        if not self._num_waiting \
+                and self._get_delay(now, self._headroom[priority]) <= 0:
+            self._register(now)
+            return
+        fut = loop.create_future()
+        deadline = None
+        if self._max_wait_s is not None:
+            deadline = now + self._max_wait_s
+        self._waiters[priority].append((deadline, fut))
+        self._num_waiting += 1
+        # the new waiter may go before the ones the timer waits for
+        if self._timer is None:
+            self._dispatch()
+        else:
+            self._timer.cancel()
+            self._dispatch(notify=False)
+        await fut
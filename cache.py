@@ -0,0 +1,280 @@
+import os
+import sys
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from time import time
+from .utils import makedirs
+
+
+L = logging.getLogger(__name__)
+
+
+def estimate_size(value):
+    """Return approximate memory footprint of value, including what its
+    containers hold."""
+    size = 0
+    seen = set()
+    stack = [value]
+    while stack:
+        x = stack.pop()
+        if isinstance(x, (bytes, bytearray, str)):
+            size += len(x)
+            continue
+        size += sys.getsizeof(x)
+        if isinstance(x, dict):
+            if id(x) in seen:
+                continue
+            seen.add(id(x))
+            stack.extend(x.keys())
+            stack.extend(x.values())
+        elif isinstance(x, (list, tuple, set, frozenset)):
+            if id(x) in seen:
+                continue
+            seen.add(id(x))
+            stack.extend(x)
+    return size
+
+
+class _Entry:
+
+    __slots__ = ("value", "size", "timestamp", "expires")
+
+    def __init__(self, value, size, timestamp, expires):
+        self.value = value
+        self.size = size
+        self.timestamp = timestamp
+        self.expires = expires
+
+
+class TTLCache:
+
+    """LRU cache bounded by total size, with per-entry time to live.
+
+    Expired entries are not dropped on lookup but reported as stale, so that
+    callers may serve them while refreshing.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Size budget, least recently used entries are evicted beyond it.
+    default_ttl : float
+        Time to live in seconds for entries put without ttl. None means no
+        expiry.
+    size_fn : callable
+        Returns the size of a value, defaults to `estimate_size`.
+    """
+
+    FRESH = "fresh"
+    STALE = "stale"
+
+    def __init__(self, max_bytes=256_000_000, default_ttl=None, size_fn=None):
+        self._max_bytes = max_bytes
+        self._default_ttl = default_ttl
+        self._size_fn = size_fn or estimate_size
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._stats = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+        }
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+    def keys(self):
+        return list(self._entries)
+
+
+    def lookup(self, key, max_age=None):
+        """Return (value, state) where state is FRESH, STALE or None for a
+        miss.
+
+        An entry is stale if its ttl has passed or it's older than max_age
+        seconds.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self._stats["misses"] += 1
+            return None, None
+        self._entries.move_to_end(key)
+        now = time()
+        if (entry.expires is not None and now >= entry.expires) or \
+                (max_age is not None and now - entry.timestamp >= max_age):
+            self._stats["stale_hits"] += 1
+            return entry.value, self.STALE
+        self._stats["hits"] += 1
+        return entry.value, self.FRESH
+
+
+    def get_timestamp(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            return entry.timestamp
+
+
+    def put(self, key, value, ttl=None, timestamp=None, size=None):
+        if timestamp is None:
+            timestamp = time()
+        if ttl is None:
+            ttl = self._default_ttl
+        if size is None:
+            size = self._size_fn(value)
+        expires = None if ttl is None else timestamp + ttl
+        self.pop(key)
+        if size > self._max_bytes:
+            return
+        self._entries[key] = _Entry(value, size, timestamp, expires)
+        self._bytes += size
+        while self._bytes > self._max_bytes:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self._stats["evictions"] += 1
+
+
+    def pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+            return entry.value
+
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+
+    def stats(self):
+        res = dict(self._stats)
+        res["entries"] = len(self._entries)
+        res["bytes"] = self._bytes
+        return res
+
+
+###############################################################################
+
+
+class DiskCache:
+
+    """Persistent store of http response bodies with their validators.
+
+    Each url is stored in its own file, a json metadata line (url, etag,
+    last_modified, timestamp) followed by the raw body. Files are
+    replaced atomically so that a crash never leaves a partial entry.
+
+    The files take at most max_bytes, least recently used ones are removed
+    beyond it. Methods may be called from executor threads.
+    """
+
+    def __init__(self, path, max_bytes=1_000_000_000):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        makedirs(path)
+        # file name -> size, least recently used first
+        self._files = OrderedDict()
+        self._bytes = 0
+        entries = []
+        for e in os.scandir(path):
+            if not e.is_file():
+                continue
+            if e.name.endswith(".tmp"):
+                # left behind by a crash
+                os.remove(e.path)
+                continue
+            st = e.stat()
+            entries.append((st.st_mtime, e.name, st.st_size))
+        for _, name, size in sorted(entries):
+            self._files[name] = size
+            self._bytes += size
+        self._evict()
+
+
+    def _get_name(self, url):
+        return hashlib.sha1(url.encode()).hexdigest()
+
+
+    def _evict(self):
+        while self._bytes > self._max_bytes:
+            name, size = self._files.popitem(last=False)
+            self._bytes -= size
+            try:
+                os.remove(os.path.join(self._path, name))
+            except FileNotFoundError:
+                pass
+
+
+    def _forget(self, name):
+        size = self._files.pop(name, None)
+        if size is not None:
+            self._bytes -= size
+
+
+    def get(self, url):
+        """Return (body, meta) of url or None if not stored."""
+        name = self._get_name(url)
+        try:
+            with open(os.path.join(self._path, name), "rb") as f:
+                meta = json.loads(f.readline().decode())
+                body = f.read()
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as err:
+            L.warning(f"unreadable disk cache entry for {url}: {err}")
+            return
+        if meta.get("url") != url:
+            return
+        with self._lock:
+            if name in self._files:
+                self._files.move_to_end(name)
+        return body, meta
+
+
+    def put(self, url, body, meta):
+        meta = dict(meta, url=url)
+        name = self._get_name(url)
+        fn = os.path.join(self._path, name)
+        tmp_fn = fn + ".tmp"
+        with open(tmp_fn, "wb") as f:
+            f.write(json.dumps(meta).encode() + b"\n")
+            f.write(body)
+            size = f.tell()
+        with self._lock:
+            if size > self._max_bytes:
+                os.remove(tmp_fn)
+                self._forget(name)
+                try:
+                    os.remove(fn)
+                except FileNotFoundError:
+                    pass
+                return
+            os.replace(tmp_fn, fn)
+            self._forget(name)
+            self._files[name] = size
+            self._bytes += size
+            self._evict()
+
+
+    def remove(self, url):
+        name = self._get_name(url)
+        with self._lock:
+            self._forget(name)
+            try:
+                os.remove(os.path.join(self._path, name))
+            except FileNotFoundError:
+                pass
+
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._files), "bytes": self._bytes}
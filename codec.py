@@ -0,0 +1,465 @@
+"""Wire codecs for ZMAPI messages.
+
+Every encoded message starts with a marker byte that tells which codec was
+used to encode it. The original wire format, a space followed by JSON, is the
+marker b" ". Receivers detect the codec from the marker, so peers using
+different codecs keep interoperating. Controllers reply with the codec the
+request was encoded with.
+
+HeaderFirstCodec frames the Header separately from the Body, so that the
+Header can be read without decoding the Body. Such frames decode into a
+LazyMessage that decodes its Body on first access.
+
+Several encoded messages can be packed into a single batch frame, which has
+its own marker byte (BATCH_MARKER) followed by length prefixed frames.
+
+A codec is selected per socket by passing `codec` to the constructor of the
+component owning the socket, or for the whole process with
+`set_default_codec`.
+"""
+
+import json
+import re
+import struct
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JSONCodec:
+
+    """Compatible default: stdlib json prefixed with a space."""
+
+    name = "json"
+    marker = b" "
+
+    def encode(self, msg) -> bytes:
+        if type(msg) is LazyMessage:
+            msg.load()
+        return (" " + json.dumps(msg)).encode()
+
+    def decode(self, data: bytes):
+        # json.loads accepts bytes and skips the leading whitespace
+        return json.loads(data)
+
+    def patch(self, data: bytes, header=None, body=None) -> bytes:
+        """Return data with the given Header and Body fields set.
+
+        The fields are spliced into the encoded message when it starts with
+        the Header followed by the Body, which is what Publisher produces.
+        Otherwise the message is decoded and encoded again.
+        """
+        res = _splice_json(data, header or {}, body or {})
+        if res is None:
+            res = _patch_decoded(self, data, header, body)
+        return res
+
+
+class FastJSONCodec(JSONCodec):
+
+    """Same wire format as JSONCodec but backed by orjson."""
+
+    name = "fastjson"
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError("orjson is required for FastJSONCodec")
+
+    def encode(self, msg) -> bytes:
+        if type(msg) is LazyMessage:
+            msg.load()
+        return b" " + orjson.dumps(msg)
+
+    def decode(self, data: bytes):
+        return orjson.loads(data)
+
+
+class MsgPackCodec:
+
+    """Binary codec backed by msgpack."""
+
+    name = "msgpack"
+    marker = b"\x01"
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("msgpack is required for MsgPackCodec")
+
+    def encode(self, msg) -> bytes:
+        if type(msg) is LazyMessage:
+            msg.load()
+        return b"\x01" + msgpack.packb(msg, use_bin_type=True)
+
+    def decode(self, data: bytes):
+        return msgpack.unpackb(memoryview(data)[1:], raw=False)
+
+    def patch(self, data: bytes, header=None, body=None) -> bytes:
+        return _patch_decoded(self, data, header, body)
+
+
+class LazyMessage(dict):
+
+    """Message dict that decodes its Body on first access.
+
+    Note that iterating the dict directly with dict methods, as C extensions
+    do, does not see the Body before load() has been called.
+    """
+
+    __slots__ = ("_body_data",)
+
+    def __init__(self, header, body_data):
+        super().__init__(Header=header)
+        self._body_data = body_data
+
+    def load(self):
+        if self._body_data is not None:
+            dict.__setitem__(self, "Body", decode_msg(self._body_data))
+            self._body_data = None
+        return self
+
+    @property
+    def loaded(self):
+        return self._body_data is None
+
+    def __missing__(self, key):
+        if key == "Body" and self._body_data is not None:
+            return self.load()["Body"]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        if key == "Body" and self._body_data is not None:
+            return True
+        return super().__contains__(key)
+
+    def __iter__(self):
+        return iter(self.load().keys())
+
+    def __len__(self):
+        return super().__len__() + (self._body_data is not None)
+
+    def __repr__(self):
+        return repr(dict(self.load()))
+
+    def __eq__(self, other):
+        return dict.__eq__(self.load(), other)
+
+    def get(self, key, default=None):
+        if key == "Body":
+            self.load()
+        return super().get(key, default)
+
+    def keys(self):
+        self.load()
+        return super().keys()
+
+    def values(self):
+        self.load()
+        return super().values()
+
+    def items(self):
+        self.load()
+        return super().items()
+
+    def copy(self):
+        return dict(self.items())
+
+
+class HeaderFirstCodec:
+
+    """Frames Header and Body separately.
+
+    Layout: marker, 4 byte big-endian length of the encoded Header, encoded
+    Header, encoded Body. Header and Body are encoded with the inner codec.
+    Messages with top-level fields other than Header and Body are encoded
+    with the inner codec alone.
+    """
+
+    name = "headerfirst"
+    marker = b"\x03"
+    _len = struct.Struct(">I")
+
+    def __init__(self, inner=None):
+        if inner is None:
+            inner = JSONCodec.name
+        inner = get_codec(inner)
+        if isinstance(inner, HeaderFirstCodec):
+            raise ValueError("inner codec can't be HeaderFirstCodec")
+        self._inner = inner
+
+    def encode(self, msg) -> bytes:
+        if type(msg) is LazyMessage and not msg.loaded:
+            # body passes through undecoded
+            body_data = msg._body_data
+        elif len(msg) == 2 and "Body" in msg and "Header" in msg:
+            body_data = self._inner.encode(msg["Body"])
+        else:
+            return self._inner.encode(msg)
+        header_data = self._inner.encode(msg["Header"])
+        return b"".join([self.marker,
+                         self._len.pack(len(header_data)),
+                         header_data,
+                         body_data])
+
+    def _split(self, data):
+        n, = self._len.unpack_from(data, 1)
+        pos = 1 + self._len.size
+        return data[pos:pos+n], data[pos+n:]
+
+    def decode_header(self, data: bytes):
+        header_data, _ = self._split(data)
+        return decode_msg(header_data, self._inner)
+
+    def decode(self, data: bytes):
+        header_data, body_data = self._split(data)
+        return LazyMessage(decode_msg(header_data, self._inner), body_data)
+
+    def patch(self, data: bytes, header=None, body=None) -> bytes:
+        msg = self.decode(data)
+        if header:
+            msg["Header"].update(header)
+        if body:
+            msg["Body"].update(body)
+        return self.encode(msg)
+
+
+def peek_header(data: bytes):
+    """Return the decoded Header of a header-first frame, otherwise None."""
+    if data[:1] != HeaderFirstCodec.marker:
+        return
+    codec = _get_codec_by_marker(data[:1])
+    if isinstance(codec, HeaderFirstCodec):
+        return codec.decode_header(data)
+
+
+# MsgType inside a leading, flat Header object
+_JSON_MSG_TYPE = re.compile(
+        rb'^ ?\{"Header": ?\{[^{}]*?"MsgType": ?"([^"\\]*)"')
+
+
+def peek_msg_type(data: bytes):
+    """Return Header.MsgType without decoding the message.
+
+    Works for header-first frames and for JSON messages that start with a
+    flat Header. Returns None if MsgType can't be found cheaply.
+    """
+    marker = data[:1]
+    if marker == b" " or marker == b"{":
+        m = _JSON_MSG_TYPE.match(data)
+        if m:
+            return m.group(1).decode()
+        return
+    header = peek_header(data)
+    if header is not None:
+        return header.get("MsgType")
+
+
+###############################################################################
+
+
+def _patch_decoded(codec, data, header, body):
+    msg = codec.decode(data)
+    if header:
+        msg["Header"].update(header)
+    if body:
+        msg["Body"].update(body)
+    return codec.encode(msg)
+
+
+_JSON_LAYOUTS = (
+    # (message prefix, Body prefix, key separator, item separator)
+    (b' {"Header": {', b', "Body": {', b": ", b", "),
+    (b' {"Header":{', b',"Body":{', b":", b","),
+)
+
+
+def _find_object_end(data, pos):
+    """Return index of the brace closing the JSON object starting at pos."""
+    depth = 0
+    in_str = False
+    escaped = False
+    for i in range(pos, len(data)):
+        c = data[i]
+        if in_str:
+            if escaped:
+                escaped = False
+            elif c == 0x5c:  # backslash
+                escaped = True
+            elif c == 0x22:  # quote
+                in_str = False
+        elif c == 0x22:
+            in_str = True
+        elif c == 0x7b:  # {
+            depth += 1
+        elif c == 0x7d:  # }
+            depth -= 1
+            if depth == 0:
+                return i
+    return -1
+
+
+def _render_fields(fields, kv_sep, item_sep):
+    return b"".join(json.dumps(k).encode() + kv_sep + json.dumps(v).encode()
+                    + item_sep for k, v in fields.items())
+
+
+def _splice_json(data, header, body):
+    for prefix, body_prefix, kv_sep, item_sep in _JSON_LAYOUTS:
+        if data.startswith(prefix):
+            break
+    else:
+        return
+    # Keys that already exist would win over the spliced ones.
+    for k in list(header) + list(body):
+        if b'"' + k.encode() + b'"' in data:
+            return
+    h_pos = len(prefix)
+    h_end = _find_object_end(data, h_pos - 1)
+    if h_end < 0 or h_end == h_pos:
+        # empty header
+        return
+    if not data.startswith(body_prefix, h_end + 1):
+        return
+    b_pos = h_end + 1 + len(body_prefix)
+    chunks = [data[:h_pos]]
+    chunks.append(_render_fields(header, kv_sep, item_sep))
+    chunks.append(data[h_pos:b_pos])
+    if body:
+        body_fields = _render_fields(body, kv_sep, item_sep)
+        if data[b_pos:b_pos+1] == b"}":
+            # empty body, drop the trailing separator
+            body_fields = body_fields[:-len(item_sep)]
+        chunks.append(body_fields)
+    chunks.append(data[b_pos:])
+    return b"".join(chunks)
+
+
+###############################################################################
+
+
+BATCH_MARKER = b"\x02"
+_FRAME_LEN = struct.Struct(">I")
+
+
+def pack_batch(frames) -> bytes:
+    """Pack encoded messages into one batch frame."""
+    chunks = [BATCH_MARKER]
+    for frame in frames:
+        chunks.append(_FRAME_LEN.pack(len(frame)))
+        chunks.append(frame)
+    return b"".join(chunks)
+
+
+def is_batch(data: bytes):
+    return data[:1] == BATCH_MARKER
+
+
+def unpack_batch(data: bytes):
+    """Return list of encoded messages packed in a batch frame."""
+    res = []
+    pos = 1
+    n = len(data)
+    while pos < n:
+        length, = _FRAME_LEN.unpack_from(data, pos)
+        pos += _FRAME_LEN.size
+        res.append(data[pos:pos+length])
+        pos += length
+    return res
+
+
+###############################################################################
+
+
+_CODEC_CLASSES = {
+    JSONCodec.name: JSONCodec,
+    FastJSONCodec.name: FastJSONCodec,
+    MsgPackCodec.name: MsgPackCodec,
+    HeaderFirstCodec.name: HeaderFirstCodec,
+}
+# codecs instantiated on first message carrying their marker
+_CLASSES_BY_MARKER = {
+    JSONCodec.marker: JSONCodec,
+    MsgPackCodec.marker: MsgPackCodec,
+    HeaderFirstCodec.marker: HeaderFirstCodec,
+}
+_codecs = {}
+_by_marker = {}
+_default = None
+
+
+def _get_codec_by_marker(marker):
+    codec = _by_marker.get(marker)
+    if codec is None:
+        klass = _CLASSES_BY_MARKER.get(marker)
+        if klass is not None:
+            try:
+                codec = get_codec(klass.name)
+            except ImportError as err:
+                raise ValueError(str(err))
+    return codec
+
+
+def register_codec(codec):
+    """Register codec instance for decoding messages with its marker."""
+    _codecs[codec.name] = codec
+    _by_marker[codec.marker] = codec
+
+
+def get_codec(codec=None):
+    """Resolve codec name or instance. None returns the default codec."""
+    if codec is None:
+        return _default
+    if type(codec) is not str:
+        return codec
+    res = _codecs.get(codec)
+    if res is None:
+        klass = _CODEC_CLASSES.get(codec)
+        if klass is None:
+            raise ValueError("unknown codec: {}".format(codec))
+        res = klass()
+        _codecs[codec] = res
+        if res.marker not in _by_marker:
+            _by_marker[res.marker] = res
+    return res
+
+
+def get_default_codec():
+    return _default
+
+
+def set_default_codec(codec):
+    """Set the process wide default codec.
+
+    The codec will also be used to decode all messages carrying its marker.
+    """
+    global _default
+    codec = get_codec(codec)
+    register_codec(codec)
+    _default = codec
+
+
+def detect_codec(data: bytes, preferred=None):
+    """Return codec matching the marker byte of data."""
+    marker = data[:1]
+    if preferred is not None and marker == preferred.marker:
+        return preferred
+    codec = _get_codec_by_marker(marker)
+    if codec is not None:
+        return codec
+    if marker == b"{":
+        # JSON without the leading space
+        return _by_marker[b" "]
+    raise ValueError("unknown codec marker: {}".format(marker))
+
+
+def decode_msg(data: bytes, preferred=None):
+    return detect_codec(data, preferred).decode(data)
+
+
+set_default_codec(JSONCodec())
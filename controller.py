@@ -1,18 +1,23 @@
 import zmq
+import os
 import sys
+import asyncio
 import logging
 import json
 import aiohttp
 import re
 import string
 from datetime import datetime
-from zmapi.utils import check_if_error
+from zmapi.utils import check_if_error, get_timestamp, get_zmapi_dir
+from zmapi.codec import get_codec, detect_codec, decode_msg, peek_msg_type
 from zmapi.exceptions import *
 from zmapi.zmq.utils import *
-from zmapi.asyncio import Throttler
+from zmapi.asyncio import Throttler, PRIORITY_NORMAL, PRIORITY_BULK
+from zmapi.cache import TTLCache, DiskCache
+from zmapi.zmq import RemoteThrottler
 from asyncio import ensure_future as create_task
 from time import time, gmtime
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from copy import deepcopy
 from uuid import uuid4
 from zmapi import fix
@@ -22,16 +27,38 @@ from base64 import b64encode, b64decode
 L = logging.getLogger(__name__)
 
 
+def static_response(f):
+    """Declare that Controller handler f always returns the same response.
+
+    The response is rendered to bytes on first call, later requests only get
+    a fresh ZMSendingTime spliced in and are answered without decoding the
+    request, nor calling `_handle_msg_2`. That's why it's only enabled by
+    default if `_handle_msg_2` is not overridden, overrides may pass
+    static_responses=True. Call `invalidate_static` when the data of the
+    responses changes.
+    """
+    f.static_response = True
+    return f
+
+
+# 19 digits like nanosecond timestamps, keeps encoded lengths unchanged
+_TIMESTAMP_SENTINEL = 1111111111111111111
+
+
 class Controller:
 
 
-    def __init__(self, sock_dn, name=None, sessionless=False):
+    def __init__(self, sock_dn, name=None, sessionless=False, codec=None,
+                 scheduler=None, static_responses=None):
         self._name = name
         if self._name:
             self._tag = "[" + self._name + "] "
         else:
             self._tag = ""
         self._sock_dn = sock_dn
+        self._codec = get_codec(codec)
+        # optional RequestScheduler, requests are not limited without one
+        self._scheduler = scheduler
         self._commands = {}
         if sessionless:
             self.session_id = None
@@ -48,21 +75,40 @@ class Controller:
                 if f:
                     self._commands[msg_type] = f
                     break
-
-
-    async def _send_reply(self, ident, msg_id, msg):
+        if static_responses is None:
+            # the _handle_msg_2 of this module reach the handler of every
+            # request, overrides elsewhere may not
+            static_responses = type(self)._handle_msg_2.__module__ == __name__
+        self._static_types = set()
+        if static_responses:
+            self._static_types = {k for k, v in self._commands.items()
+                                  if getattr(v, "static_response", False)}
+        # (msg_type, codec) -> (prefix, suffix) around ZMSendingTime
+        self._static_cache = {}
+
+
+    async def _send_reply(self, ident, msg_id, msg, codec=None):
+        """Send msg to ident. msg may be a list of raw frames followed by
+        the reply message."""
+        frames = []
+        if type(msg) is list:
+            frames = msg[:-1]
+            msg = msg[-1]
         if type(msg) == bytes:
             msg_bytes = msg
         else:
             if "ZMSendingTime" not in msg["Header"]:
                 msg["Header"]["ZMSendingTime"] = \
                         int(datetime.utcnow().timestamp() * 1e9)
-            msg_bytes = (" " + json.dumps(msg)).encode()
-        await self._sock_dn.send_multipart(ident + [b"", msg_id, msg_bytes])
+            if codec is None:
+                codec = self._codec
+            msg_bytes = codec.encode(msg)
+        await self._sock_dn.send_multipart(
+                ident + [b"", msg_id] + frames + [msg_bytes])
 
 
     async def _send_xreject(
-            self, ident, msg_id, reason, text, field_name=None):
+            self, ident, msg_id, reason, text, field_name=None, codec=None):
         d = {}
         d["Header"] = header = {}
         header["MsgType"] = fix.MsgType.ZMReject
@@ -71,16 +117,62 @@ class Controller:
         body["ZMRejectReason"] = reason
         if field_name:
             body["ZMRefFieldName"] = field_name
-        await self._send_reply(ident, msg_id, d)
+        await self._send_reply(ident, msg_id, d, codec)
 
 
     async def _handle_msg_2(self, ident, msg_raw, msg, msg_type):
         raise NotImplementedError("_handle_msg_2 must be implemented")
 
 
+    def invalidate_static(self):
+        """Drop the rendered static responses, they are rendered again on
+        next request."""
+        self._static_cache.clear()
+
+
+    def _render_static(self, msg_type, codec, res):
+        header = res["Header"]
+        header["ZMSendingTime"] = _TIMESTAMP_SENTINEL
+        parts = codec.encode(res).split(str(_TIMESTAMP_SENTINEL).encode())
+        del header["ZMSendingTime"]
+        # binary codecs can't be spliced this way
+        template = tuple(parts) if len(parts) == 2 else None
+        self._static_cache[(msg_type, codec)] = template
+        return template
+
+
+    async def _send_static(self, ident, msg_id, template):
+        prefix, suffix = template
+        msg_bytes = prefix + str(get_timestamp()).encode() + suffix
+        await self._sock_dn.send_multipart(ident + [b"", msg_id, msg_bytes])
+
+
     async def _handle_msg_1(self, ident, msg_id, msg_raw):
-        msg = json.loads(msg_raw.decode())
-        msg_type = msg["Header"]["MsgType"]
+        # reply with the same codec the request was encoded with
+        try:
+            codec = detect_codec(msg_raw, self._codec)
+            msg_type = peek_msg_type(msg_raw)
+        except Exception as e:
+            await self._reject_undecodable(ident, msg_id, e)
+            return
+        if self._static_types:
+            template = self._static_cache.get((msg_type, codec))
+            if template:
+                L.debug(self._tag + "> ident={}, MsgType={}, msg_id={} "
+                        "(static)".format(ident_to_str(ident), msg_type,
+                                          msg_id))
+                await self._send_static(ident, msg_id, template)
+                return
+        if msg_type is not None and not self._needs_body(msg_type):
+            # handled on raw bytes only, e.g. forwarded as is
+            msg = None
+        else:
+            try:
+                msg = codec.decode(msg_raw)
+                msg_type = msg["Header"]["MsgType"]
+            except Exception as e:
+                await self._reject_undecodable(ident, msg_id, e, codec)
+                return
         debug_str = "ident={}, MsgType={}, msg_id={}"
         debug_str = debug_str.format(
                 ident_to_str(ident), msg_type, msg_id)
@@ -103,22 +195,63 @@ class Controller:
                                      msg_id,
                                      reason,
                                      text,
-                                     field_name)
+                                     field_name,
+                                     codec)
         except Exception as e:
             L.exception(self._tag + "Generic ZMReject processing {}: {}"
                         .format(msg_id, str(e)))
             await self._send_xreject(ident,
                                      msg_id,
                                      fix.ZMRejectReason.Other,
-                                     "{}: {}".format(type(e).__name__, e))
+                                     "{}: {}".format(type(e).__name__, e),
+                                     codec=codec)
         else:
-            if res is not None:
-                await self._send_reply(ident, msg_id, res)
+            template = None
+            if msg_type in self._static_types and type(res) is dict:
+                template = self._render_static(msg_type, codec, res)
+            if template:
+                await self._send_static(ident, msg_id, template)
+            elif res is not None:
+                await self._send_reply(ident, msg_id, res, codec)
         L.debug(self._tag + "< " + debug_str)
 
 
+    def _needs_body(self, msg_type):
+        """Return False if requests of msg_type can be handled without
+        decoding them, `_handle_msg_2` then gets None as msg."""
+        return True
+
+
+    async def _reject_undecodable(self, ident, msg_id, err, codec=None):
+        L.warning(self._tag + "undecodable request {}: {}"
+                  .format(msg_id, err))
+        await self._send_xreject(ident,
+                                 msg_id,
+                                 fix.ZMRejectReason.Other,
+                                 "undecodable request: {}: {}".format(
+                                        type(err).__name__, err),
+                                 codec=codec)
+
+
+    async def _reject_queue_full(self, ident, msg_id, msg_raw):
+        try:
+            codec = detect_codec(msg_raw, self._codec)
+        except ValueError:
+            codec = self._codec
+        L.warning(self._tag + "request queue full, rejecting {}"
+                  .format(msg_id))
+        await self._send_xreject(ident,
+                                 msg_id,
+                                 fix.ZMRejectReason.Other,
+                                 "request queue full",
+                                 codec=codec)
+
+
     async def run(self):
         L.debug(self._tag + "controller running ...")
+        scheduler = self._scheduler
+        if scheduler:
+            create_task(scheduler.run(self._handle_msg_1))
         while True:
             msg_parts = await self._sock_dn.recv_multipart()
             try:
@@ -127,7 +260,18 @@ class Controller:
                 L.error(str(err))
                 continue
             msg_id, msg = rest
-            create_task(self._handle_msg_1(ident, msg_id, msg))
+            if not scheduler:
+                create_task(self._handle_msg_1(ident, msg_id, msg))
+                continue
+            try:
+                msg_type = peek_msg_type(msg)
+            except Exception:
+                # default priority, _handle_msg_1 rejects it
+                msg_type = None
+            if not scheduler.submit(tuple(ident),
+                                    msg_type,
+                                    (ident, msg_id, msg)):
+                await self._reject_queue_full(ident, msg_id, msg)
 
 
 ############################ CONNECTOR CONTROLLERS ############################
@@ -146,7 +290,11 @@ class ConnectorCTL(Controller):
             feats = b64encode(feats.encode()).decode()
         self._feats = feats
         self._ins_fields = kwargs.pop("ins_fields", None)
-        super().__init__(sock_dn, name=name)
+        codec = kwargs.pop("codec", None)
+        scheduler = kwargs.pop("scheduler", None)
+        static_responses = kwargs.pop("static_responses", None)
+        super().__init__(sock_dn, name=name, codec=codec, scheduler=scheduler,
+                         static_responses=static_responses)
         self._ep_name = ep_name
         self._subscriptions = {}
         self.insid_to_tid = {}
@@ -249,6 +397,7 @@ class ConnectorCTL(Controller):
     #     return res
 
 
+    @static_response
     async def ZMGetConnectorFeatures(self, ident, msg_raw, msg):
         if not self._feats:
             raise RejectException(
@@ -262,6 +411,7 @@ class ConnectorCTL(Controller):
         return res
 
 
+    @static_response
     async def ZMGetInstrumentFields(self, ident, msg_raw, msg):
         if not self._ins_fields:
             raise RejectException(
@@ -275,6 +425,7 @@ class ConnectorCTL(Controller):
         return res
 
 
+    @static_response
     async def ZMListEndpoints(self, ident, msg_raw, msg):
         res = {}
         res["Header"] = header = {}
@@ -284,6 +435,7 @@ class ConnectorCTL(Controller):
         return res
 
 
+    @static_response
     async def ZMListCapabilities(self, ident, msg_raw, msg):
         if not self._caps:
             raise RejectException(
@@ -328,97 +480,498 @@ class ConnectorCTL(Controller):
     #     # else:
 
 
+# \1 style backreferences and (?(1)...) conditionals, unless escaped
+_NUMBERED_GROUP_REF = re.compile(r"(?<!\\)(?:\\\\)*(?:\\[1-9]|\(\?\(\d)")
+
+
+class _InflightFetch:
+
+    __slots__ = ("task", "priority", "persist", "throttle")
+
+    def __init__(self, priority, persist):
+        self.task = None
+        self.priority = priority
+        self.persist = persist
+        # task waiting for the throttler, None when not waiting
+        self.throttle = None
+
+
 class RESTConnectorCTL(ConnectorCTL):
     
     """Controller that has built-in throttled and cached http fetching
-    capabilities."""
+    capabilities.
+
+    Requests share a pooled aiohttp session that is created on first use.
+    It is configured with the http_limit, http_limit_per_host,
+    http_keepalive_s, http_dns_ttl_s and http_timeout_s kwargs. Call
+    `close` on shutdown to release the connections.
+
+    Results are kept in a TTLCache of http_cache_bytes bytes. With
+    stale_while_revalidate set, `_http_get_cached` returns an expired result
+    right away and refreshes it in the background.
+
+    The http_disk_cache kwarg (True for a directory under ~/.zmapi, or a
+    path) persists response bodies with their ETag and Last-Modified
+    headers. Results missing from memory are then served from disk and
+    revalidated with a conditional GET, also across restarts. The directory
+    is kept under http_disk_cache_bytes bytes. Results of `_http_get` are
+    not persisted.
+    """
 
 
     def __init__(self, sock_dn, ctx, ep_name,
                  throttler_addr=None, name=None, **kwargs):
+        self._http_limit = kwargs.pop("http_limit", 100)
+        self._http_limit_per_host = kwargs.pop("http_limit_per_host", 10)
+        self._http_keepalive_s = kwargs.pop("http_keepalive_s", 30)
+        self._http_dns_ttl_s = kwargs.pop("http_dns_ttl_s", 300)
+        self._http_timeout_s = kwargs.pop("http_timeout_s", 60)
+        cache_bytes = kwargs.pop("http_cache_bytes", 256_000_000)
+        self._stale_while_revalidate = kwargs.pop("stale_while_revalidate",
+                                                  False)
+        disk_cache = kwargs.pop("http_disk_cache", None)
+        disk_cache_bytes = kwargs.pop("http_disk_cache_bytes", 1_000_000_000)
+        self._throttler_memo_size = kwargs.pop("throttler_memo_size", 10_000)
         super().__init__(sock_dn, ep_name, name=name, **kwargs)
+        if disk_cache is True:
+            disk_cache = os.path.join(get_zmapi_dir(), "http_cache", ep_name)
+        self._disk_cache = None
+        if disk_cache:
+            self._disk_cache = DiskCache(disk_cache, disk_cache_bytes)
+        self._http_session = None
         self._ctx = ctx
-        self._rest_result_cache = {}
+        self._rest_result_cache = TTLCache(cache_bytes)
+        # url -> _InflightFetch, shared by concurrent callers
+        self._http_inflight = {}
+        self._http_stats = {
+            "fetches": 0,
+            "coalesced": 0,
+            "disk_hits": 0,
+            "not_modified": 0,
+        }
         self._throttler_regexps = []
+        # all throttler regexps as one alternation, None if it can't be built
+        self._throttler_rex = None
+        # outer group index in _throttler_rex -> throttler
+        self._throttler_groups = {}
+        # url -> throttler or None, in LRU order
+        self._throttler_memo = OrderedDict()
         if not throttler_addr:
             throttler_addr = "inproc://throttler-notifications-" + str(uuid4())
         self._throttler_addr = throttler_addr
 
 
     async def _http_get_cached(self, url, expiration_s=sys.maxsize, **kwargs):
+        """Return cached result of url if younger than expiration_s, else
+        fetch it.
+
+        ttl is the time to live of the result stored, None for no expiry. A
+        stale result is returned without waiting for the refresh if
+        allow_stale is set, which defaults to stale_while_revalidate, or to
+        True for results loaded from the disk cache. Results are stored in
+        the disk cache unless persist is False.
+
+        priority is the Throttler lane used when fetching, refreshes in the
+        background use PRIORITY_BULK. Joining a fetch in flight that still
+        waits for its throttler moves it up to priority.
+        """
         session = kwargs.pop("session", None)
-        holder = self._rest_result_cache.get(url)
-        data = None
-        if holder is not None:
-            elapsed = time() - holder["timestamp"]
-            if elapsed < expiration_s:
-                data = holder["data"]
-        if data is None:
-            # find first throttler matching url and throttle if necessary
-            for rex, throttler in self._throttler_regexps:
-                if rex.fullmatch(url):
-                    await throttler()
-                    break
-            timestamp = time()
+        ttl = kwargs.pop("ttl", None)
+        priority = kwargs.pop("priority", PRIORITY_NORMAL)
+        allow_stale = kwargs.pop("allow_stale", None)
+        persist = kwargs.pop("persist", True)
+        data, state = self._rest_result_cache.lookup(url, expiration_s)
+        if state is None and self._disk_cache is not None \
+                and allow_stale is not False:
+            data, state = await self._load_from_disk(url, expiration_s)
+            if allow_stale is None:
+                allow_stale = True
+        if allow_stale is None:
+            allow_stale = self._stale_while_revalidate
+        if state == TTLCache.FRESH:
+            return data
+        if state == TTLCache.STALE and allow_stale:
+            self._start_fetch(session, url, ttl, PRIORITY_BULK, persist)
+            return data
+        task = self._start_fetch(session, url, ttl, priority, persist)
+        # the fetch goes on for the others if this caller is cancelled
+        return await asyncio.shield(task)
+
+
+    async def _load_from_disk(self, url, expiration_s):
+        entry = await asyncio.get_event_loop().run_in_executor(
+                None, self._disk_cache.get, url)
+        if entry is None:
+            return None, None
+        body, meta = entry
+        try:
+            data = self._process_data(body, url)
+        except Exception as err:
+            L.warning(self._tag + "error processing cached {}: {}"
+                      .format(url, err))
+            return None, None
+        self._http_stats["disk_hits"] += 1
+        # stale right away, so the first hit is served and revalidated
+        self._rest_result_cache.put(url, data, ttl=0,
+                                    timestamp=meta["timestamp"],
+                                    size=len(body))
+        return self._rest_result_cache.lookup(url, expiration_s)
+
+
+    def _start_fetch(self, session, url, ttl, priority, persist=True):
+        fetch = self._http_inflight.get(url)
+        if fetch is None:
+            fetch = _InflightFetch(priority, persist)
+            fetch.task = create_task(
+                    self._fetch_and_cache(session, url, ttl, fetch))
+            self._http_inflight[url] = fetch
+            fetch.task.add_done_callback(
+                    lambda t: self._on_fetch_done(url, t))
+            self._http_stats["fetches"] += 1
+            return fetch.task
+        self._http_stats["coalesced"] += 1
+        fetch.persist = fetch.persist or persist
+        if priority < fetch.priority:
+            fetch.priority = priority
+            if fetch.throttle is not None:
+                # queue again in the lane of the new caller
+                fetch.throttle.cancel()
+        return fetch.task
+
+
+    async def _wait_throttler(self, throttler, fetch):
+        while True:
+            waiter = fetch.throttle = create_task(throttler(fetch.priority))
+            try:
+                await asyncio.wait([waiter])
+            except asyncio.CancelledError:
+                waiter.cancel()
+                raise
+            if not waiter.cancelled():
+                break
+        fetch.throttle = None
+        waiter.result()
+
+
+    async def _fetch_and_cache(self, session, url, ttl, fetch):
+        throttler = self._get_throttler(url)
+        if throttler is not None:
+            await self._wait_throttler(throttler, fetch)
+        timestamp = time()
+        if self._disk_cache is None or not fetch.persist:
             data = await self._do_http_get(session, url)
-            holder = dict(data=data, timestamp=timestamp)
-            self._rest_result_cache[url] = holder
+        else:
+            data = await self._revalidate(session, url, timestamp)
+        self._rest_result_cache.put(url, data, ttl=ttl, timestamp=timestamp)
         return data
 
 
+    async def _revalidate(self, session, url, timestamp):
+        loop = asyncio.get_event_loop()
+        entry = await loop.run_in_executor(None, self._disk_cache.get, url)
+        headers = {}
+        if entry is not None:
+            meta = entry[1]
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        status, body, resp_headers = await self._do_http_get_raw(
+                session, url, headers=headers)
+        if status == 304 and entry is not None:
+            self._http_stats["not_modified"] += 1
+            body, meta = entry
+        else:
+            meta = {
+                "etag": resp_headers.get("ETag"),
+                "last_modified": resp_headers.get("Last-Modified"),
+            }
+        meta = dict(meta, timestamp=timestamp)
+        await loop.run_in_executor(
+                None, self._disk_cache.put, url, body, meta)
+        return self._process_data(body, url)
+
+
+    def _on_fetch_done(self, url, task):
+        fetch = self._http_inflight.get(url)
+        if fetch is not None and fetch.task is task:
+            del self._http_inflight[url]
+        if not task.cancelled() and task.exception():
+            # callers have seen it already, but background refreshes have none
+            err = task.exception()
+            L.warning(self._tag + "error fetching {}: {}: {}"
+                      .format(url, type(err).__name__, err))
+
+
+    def http_stats(self):
+        """Return counts of http fetches done, of fetches saved by joining one
+        in flight and the result cache statistics."""
+        res = dict(self._http_stats)
+        res["cache"] = self._rest_result_cache.stats()
+        if self._disk_cache is not None:
+            res["disk_cache"] = self._disk_cache.stats()
+        return res
+
+
     async def _http_get(self, url, **kwargs):
-        return await self._http_get_cached(url, expiration_s=0, **kwargs)
+        return await self._http_get_cached(url, expiration_s=0,
+                                           allow_stale=False, persist=False,
+                                           **kwargs)
 
 
-    def _add_throttler(self, regexp, ts_count, tlim_s, tag=None):
+    def _add_throttler(self, regexp, ts_count, tlim_s, tag=None, **kwargs):
+        """Throttle urls matching regexp, kwargs are passed to Throttler."""
         rex = re.compile(regexp)
         sock = self._ctx.socket(zmq.PUB)
         sock.connect(self._throttler_addr)
         if not tag:
             tag = regexp
-        throttler = Throttler(ts_count, tlim_s, sock, tag)
+        throttler = Throttler(ts_count, tlim_s, sock, tag, **kwargs)
         self._throttler_regexps.append((rex, throttler))
+        self._index_throttlers()
 
 
-    async def _do_http_get(self, session, url):
-        close_session = False
+    def _add_remote_throttler(self, regexp, dealer, name, timeout=None):
+        """Throttle urls matching regexp with the budget called name of the
+        ThrottlerService dealer is connected to."""
+        rex = re.compile(regexp)
+        throttler = RemoteThrottler(dealer, name, timeout)
+        self._throttler_regexps.append((rex, throttler))
+        self._index_throttlers()
+
+
+    def _index_throttlers(self):
+        self._throttler_memo.clear()
+        self._throttler_groups = {}
+        self._throttler_rex = None
+        parts = []
+        group = 1
+        for rex, throttler in self._throttler_regexps:
+            if _NUMBERED_GROUP_REF.search(rex.pattern):
+                # group numbers shift in the combined regex, scan linearly
+                return
+            parts.append("({})".format(rex.pattern))
+            self._throttler_groups[group] = throttler
+            group += rex.groups + 1
+        try:
+            self._throttler_rex = re.compile("|".join(parts))
+        except re.error:
+            # e.g. inline flags or clashing group names, scan linearly
+            pass
+
+
+    def _get_throttler(self, url):
+        """Return the throttler of the first regexp matching url."""
+        memo = self._throttler_memo
+        try:
+            throttler = memo[url]
+        except KeyError:
+            pass
+        else:
+            memo.move_to_end(url)
+            return throttler
+        throttler = None
+        if self._throttler_rex is not None:
+            # alternatives are tried in order, so the first pattern wins and
+            # its outer group is the last one closed
+            m = self._throttler_rex.fullmatch(url)
+            if m:
+                throttler = self._throttler_groups[m.lastindex]
+        else:
+            for rex, t in self._throttler_regexps:
+                if rex.fullmatch(url):
+                    throttler = t
+                    break
+        memo[url] = throttler
+        if len(memo) > self._throttler_memo_size:
+            memo.popitem(last=False)
+        return throttler
+
+
+    def _get_http_session(self):
+        if self._http_session is None or self._http_session.closed:
+            connector = aiohttp.TCPConnector(
+                    limit=self._http_limit,
+                    limit_per_host=self._http_limit_per_host,
+                    keepalive_timeout=self._http_keepalive_s,
+                    ttl_dns_cache=self._http_dns_ttl_s)
+            timeout = aiohttp.ClientTimeout(total=self._http_timeout_s)
+            self._http_session = aiohttp.ClientSession(connector=connector,
+                                                       timeout=timeout)
+        return self._http_session
+
+
+    async def close(self):
+        """Close the pooled http session."""
+        if self._http_session is not None:
+            await self._http_session.close()
+            self._http_session = None
+
+
+    async def _do_http_get_raw(self, session, url, headers=None):
+        """Return (status, body, headers) of GET url. Status 304 is
+        accepted if headers make the request conditional."""
         if session is None:
-            session = aiohttp.ClientSession()
-            close_session = True
-        data = None
-        async with session.get(url) as r:
-            if r.status < 200 or r.status >= 300:
+            session = self._get_http_session()
+        async with session.get(url, headers=headers) as r:
+            if (r.status < 200 or r.status >= 300) and \
+                    not (r.status == 304 and headers):
                 raise IOError("GET {}: status {}".format(url, r.status))
-            data = await r.read()
-        if close_session:
-            await session.close()
+            return r.status, await r.read(), r.headers
+
+
+    def _process_data(self, data, url):
         if hasattr(self, "_process_fetched_data"):
             data = self._process_fetched_data(data, url)
         return data
 
 
+    async def _do_http_get(self, session, url):
+        _, data, _ = await self._do_http_get_raw(session, url)
+        return self._process_data(data, url)
+
+
 ########################### MIDDLEWARE CONTROLLERS ############################
 
 
-class MiddlewareCTL(Controller):
+# Suggested MiddlewareCTL cache_policy: MsgType -> ttl of cached replies.
+DEFAULT_CACHE_POLICY = {
+    fix.MsgType.ZMListDirectory: 60,
+    fix.MsgType.ZMListEndpoints: 60,
+    fix.MsgType.SecurityListRequest: 60,
+    fix.MsgType.ZMGetInstrumentFields: 3600,
+}
+
+
+# Published MsgType -> cached MsgTypes its events may invalidate.
+DEFAULT_CACHE_INVALIDATION = {
+    fix.MsgType.SecurityDefinition: [
+        fix.MsgType.SecurityListRequest,
+        fix.MsgType.SecurityDefinitionRequest,
+        fix.MsgType.ZMListDirectory,
+    ],
+    fix.MsgType.MarketDefinition: [
+        fix.MsgType.MarketDefinitionRequest,
+        fix.MsgType.ZMListDirectory,
+    ],
+}
 
 
-    def __init__(self, sock_dn, dealer, publisher=None):
-        super().__init__(sock_dn)
+class MiddlewareCTL(Controller):
+
+    """Controller that handles some requests itself and forwards the rest
+    upstream through dealer.
+
+    With passthrough, requests of MsgTypes without a handler are forwarded
+    without being decoded, their MsgType is peeked from the raw bytes. By
+    default it's enabled unless `_handle_msg_2` is overridden, as overrides
+    may look at such requests. Those can extend `_needs_body` and pass
+    passthrough=True.
+
+    Forwarded requests of MsgTypes in the cache_policy kwarg (MsgType ->
+    ttl, see DEFAULT_CACHE_POLICY) are cached by MsgType, ZMEndpoint and
+    body, and identical ones in flight share one upstream request.
+    Events published through publisher drop the replies they may have
+    outdated according to the cache_invalidation kwarg, see `handle_event`.
+    """
+
+
+    def __init__(self, sock_dn, dealer, publisher=None, codec=None,
+                 scheduler=None, passthrough=None, **kwargs):
+        self._cache_policy = kwargs.pop("cache_policy", None) or {}
+        self._cache_invalidation = kwargs.pop(
+                "cache_invalidation", DEFAULT_CACHE_INVALIDATION)
+        cache_bytes = kwargs.pop("cache_bytes", 64_000_000)
+        super().__init__(sock_dn, codec=codec, scheduler=scheduler, **kwargs)
         self._dealer = dealer
         self._pub = publisher
+        if passthrough is None:
+            passthrough = type(self)._handle_msg_2 \
+                    is MiddlewareCTL._handle_msg_2
+        self._passthrough = passthrough
+        # (MsgType, ZMEndpoint, codec marker, body) -> upstream reply
+        self._upstream_cache = TTLCache(cache_bytes)
+        # same key -> task forwarding it, shared by identical requests
+        self._upstream_inflight = {}
+        self._upstream_stats = {"forwarded": 0, "coalesced": 0}
+        if publisher is not None and self._cache_policy:
+            publisher.add_listener(self.handle_event)
+
+
+    def _needs_body(self, msg_type):
+        return not self._passthrough or msg_type in self._commands \
+                or msg_type in self._cache_policy
+
+
+    def _get_cache_key(self, msg_raw, msg, msg_type):
+        body = json.dumps(msg.get("Body"), sort_keys=True, default=str)
+        return (msg_type, msg["Header"].get("ZMEndpoint"), msg_raw[:1], body)
+
+
+    async def _forward_cached(self, ident, msg_raw, msg, msg_type):
+        key = self._get_cache_key(msg_raw, msg, msg_type)
+        res, state = self._upstream_cache.lookup(key)
+        if state == TTLCache.FRESH:
+            return res
+        task = self._upstream_inflight.get(key)
+        if task is None:
+            task = create_task(self._send_upstream(ident, msg_raw, msg))
+            self._upstream_inflight[key] = task
+            task.add_done_callback(
+                    lambda t: self._on_forward_done(key, msg_type, t))
+            self._upstream_stats["forwarded"] += 1
+        else:
+            self._upstream_stats["coalesced"] += 1
+        # the request goes on for the others if this caller is cancelled
+        return (await asyncio.shield(task))[-1]
+
+
+    def _on_forward_done(self, key, msg_type, task):
+        if self._upstream_inflight.get(key) is task:
+            del self._upstream_inflight[key]
+        if task.cancelled() or task.exception() or not task.result():
+            return
+        res = task.result()[-1]
+        if peek_msg_type(res) == fix.MsgType.ZMReject:
+            return
+        self._upstream_cache.put(key, res, ttl=self._cache_policy[msg_type])
+
+
+    def handle_event(self, msg_type):
+        """Drop cached replies that a published event of msg_type may have
+        made outdated."""
+        self.invalidate(self._cache_invalidation.get(msg_type, ()))
+
+
+    def invalidate(self, msg_types=None):
+        """Drop cached replies of msg_types, all of them by default."""
+        if msg_types is None:
+            self._upstream_cache.clear()
+            return
+        msg_types = set(msg_types)
+        for key in self._upstream_cache.keys():
+            if key[0] in msg_types:
+                self._upstream_cache.pop(key)
+
+
+    def cache_stats(self):
+        """Return counts of requests forwarded upstream, of ones that joined
+        an identical request in flight and the reply cache statistics."""
+        res = dict(self._upstream_stats)
+        res["cache"] = self._upstream_cache.stats()
+        return res
 
 
     async def send_recv_msg(self, msg, **kwargs):
         check_error = kwargs.get("check_error", False)
         ident = kwargs.get("ident", None)
         timeout = kwargs.get("timeout", None)
-        msg_bytes = (" " + json.dumps(msg)).encode()
+        msg_bytes = self._codec.encode(msg)
         msg_parts = await self._dealer.send_recv_msg(
                 msg_bytes, ident=ident, timeout=timeout)
         if not msg_parts:
             return
-        msg = json.loads(msg_parts[-1].decode())
+        msg = decode_msg(msg_parts[-1], self._codec)
         if check_error:
             check_if_error(msg)
         return msg
@@ -464,20 +1017,35 @@ class MiddlewareCTL(Controller):
         topic = body.get("ZMPubTopic")
         req_id = body.get("ZMReqID")
         send_to_pub = body.get("ZMSendToPub", False)
+        raw_frames = body.get("ZMRawFrames", False)
         res = {}
         res["Header"] = header = {}
         header["MsgType"] = fix.MsgType.ZMResendRequestResponse
         res["Body"] = body = {}
-        res["ZMSessionID"] = self.session_id
+        body["ZMSessionID"] = self.session_id
         if send_to_pub:
-            await self._pub.republish(start, end, topic)
-            body["Text"] = "republished to pub"
+            if req_id is None:
+                raise RejectException(
+                        "ZMReqID is required with ZMSendToPub",
+                        fix.ZMRejectReason.RequiredFieldMissing,
+                        "ZMReqID")
+            count = await self._pub.republish(start, end, topic, req_id)
+            if count is None:
+                body["Text"] = "superseded by newer request"
+            else:
+                body["Text"] = "republished to pub"
             return res
-        _, messages = zip(self._pub.fetch_messages(start, end, topic))
+        messages = self._pub.fetch_messages(start, end, topic)
+        if raw_frames:
+            # messages as they were published, one frame each before res
+            body["ZMPubMsgCount"] = len(messages)
+            if messages:
+                body["BeginSeqNo"] = messages[0][0]
+                body["EndSeqNo"] = messages[-1][0]
+            return [msg_bytes for _, msg_bytes in messages] + [res]
         body["ZMNoPubMessages"] = group = []
-        for msg in messages:
-            msg = b64encode((" " + json.dumps(msg)).encode()).decode()
-            group.append(msg)
+        for _, msg_bytes in messages:
+            group.append(b64encode(msg_bytes).decode())
         # if topics[0] is not None:  # if first topic is None, all of them are
         #     body["ZMNoSubscriberTopics"] = group = []
         #     for topic in topics:
@@ -499,11 +1067,155 @@ class MiddlewareCTL(Controller):
         if f:
             return await f(self, ident, msg_raw, msg)
         if not f:
-            res = await self._dealer.send_recv_msg(msg_raw, ident=ident)
-            return res[-1]
+            if msg_type in self._cache_policy:
+                return await self._forward_cached(
+                        ident, msg_raw, msg, msg_type)
+            res = await self._send_upstream(ident, msg_raw, msg)
+            # keep raw frames preceding the reply, if any
+            res = get_reply_frames(res)
+            return res[0] if len(res) == 1 else res
+
+
+    async def _send_upstream(self, ident, msg_raw, msg, timeout=None):
+        """Forward msg_raw upstream and return the reply parts."""
+        return await self._dealer.send_recv_msg(
+                msg_raw, ident=ident, timeout=timeout)
 
 
     async def run(self):
         if not self._dealer.running:
             create_task(self._dealer.run())
         await super().run()
+
+
+# Broadcast MsgType -> repeating group merged from the upstream responses.
+DEFAULT_BROADCAST_GROUPS = {
+    fix.MsgType.ZMListEndpoints: "ZMNoEndpoints",
+    fix.MsgType.ZMListDirectory: "ZMNoDirEntries",
+    fix.MsgType.SecurityListRequest: "NoRelatedSym",
+}
+
+
+class FanoutMiddlewareCTL(MiddlewareCTL):
+
+    """Middleware in front of several upstream connectors.
+
+    Requests are routed to the upstream of their Header.ZMEndpoint, or of
+    default_endpoint if they have none. Requests of broadcast MsgTypes
+    without ZMEndpoint are sent to all upstreams concurrently and the
+    repeating groups of the responses are merged. An upstream that rejects
+    or doesn't reply within broadcast_timeout milliseconds is left out and
+    named in the Text of the merged response.
+
+    Parameters
+    ----------
+    dealers : dict
+        Endpoint -> ReturningDealer. Several endpoints may share a dealer.
+    """
+
+
+    def __init__(self, sock_dn, dealers, publisher=None, codec=None,
+                 scheduler=None, **kwargs):
+        self._dealers = dealers
+        self._broadcast_timeout = kwargs.pop("broadcast_timeout", 5000)
+        self._broadcast_groups = kwargs.pop("broadcast_groups",
+                                            DEFAULT_BROADCAST_GROUPS)
+        default_ep = kwargs.pop("default_endpoint", None)
+        if default_ep is None and len(set(map(id, dealers.values()))) == 1:
+            default_ep = next(iter(dealers))
+        self._default_ep = default_ep
+        dealer = dealers[default_ep] if default_ep is not None else None
+        super().__init__(sock_dn, dealer, publisher=publisher, codec=codec,
+                         scheduler=scheduler, **kwargs)
+        # distinct dealer -> its endpoints, for broadcasting
+        self._upstreams = {}
+        for endpoint, dealer in dealers.items():
+            self._upstreams.setdefault(dealer, []).append(endpoint)
+
+
+    def _needs_body(self, msg_type):
+        # ZMEndpoint is needed for routing
+        return True
+
+
+    def _get_dealer(self, endpoint):
+        if endpoint is None:
+            endpoint = self._default_ep
+            if endpoint is None:
+                raise RejectException(
+                        "ZMEndpoint is required",
+                        fix.ZMRejectReason.RequiredFieldMissing,
+                        "ZMEndpoint")
+        dealer = self._dealers.get(endpoint)
+        if dealer is None:
+            raise RejectException(
+                    "unknown endpoint: {}".format(endpoint),
+                    fix.ZMRejectReason.InvalidValue,
+                    "ZMEndpoint")
+        return dealer
+
+
+    async def _send_upstream(self, ident, msg_raw, msg, timeout=None):
+        dealer = self._get_dealer(msg["Header"].get("ZMEndpoint"))
+        return await dealer.send_recv_msg(
+                msg_raw, ident=ident, timeout=timeout)
+
+
+    async def _handle_msg_2(self, ident, msg_raw, msg, msg_type):
+        if msg_type not in self._commands \
+                and msg_type in self._broadcast_groups \
+                and msg["Header"].get("ZMEndpoint") is None:
+            return await self._broadcast(ident, msg_raw, msg_type)
+        return await super()._handle_msg_2(ident, msg_raw, msg, msg_type)
+
+
+    async def _broadcast(self, ident, msg_raw, msg_type):
+        upstreams = list(self._upstreams.items())
+        results = await asyncio.gather(
+                *[dealer.send_recv_msg(msg_raw, ident=ident,
+                                       timeout=self._broadcast_timeout)
+                  for dealer, _ in upstreams],
+                return_exceptions=True)
+        group_name = self._broadcast_groups[msg_type]
+        merged = None
+        failures = []
+        for (_, endpoints), res in zip(upstreams, results):
+            name = "/".join(endpoints)
+            if isinstance(res, BaseException):
+                failures.append("{}: {}".format(name, res))
+                continue
+            if not res:
+                failures.append("{}: timeout".format(name))
+                continue
+            res = decode_msg(res[-1], self._codec)
+            if res["Header"]["MsgType"] == fix.MsgType.ZMReject:
+                failures.append("{}: {}".format(
+                        name, res["Body"].get("Text", "rejected")))
+                continue
+            group = res["Body"].get(group_name, [])
+            if merged is None:
+                merged = res
+                merged["Body"][group_name] = list(group)
+                continue
+            merged_group = merged["Body"][group_name]
+            for x in group:
+                # endpoints may be served by several upstreams
+                if type(x) is str and x in merged_group:
+                    continue
+                merged_group.append(x)
+        if merged is None:
+            raise RejectException("all upstreams failed: " +
+                                  "; ".join(failures))
+        # stamped anew when sent
+        merged["Header"].pop("ZMSendingTime", None)
+        if failures:
+            merged["Body"]["Text"] = "partial result, failed upstreams: " \
+                                     + "; ".join(failures)
+        return merged
+
+
+    async def run(self):
+        for dealer in self._upstreams:
+            if not dealer.running:
+                create_task(dealer.run())
+        await Controller.run(self)
@@ -0,0 +1,514 @@
+"""Append-only, segmented message journal.
+
+Each topic has its own directory of segment files. A segment is a sequence
+of records, every record being a fixed size header (seq_num, length)
+followed by the serialized message. Segments are named after the first
+seq_num they contain.
+
+An in-memory index maps seq_num to (segment, offset), so reading a range is a
+binary search followed by a sequential read regardless of how many segments
+the journal has.
+"""
+
+import os
+import struct
+import logging
+import queue
+import threading
+from collections import deque
+from time import time
+from array import array
+from bisect import bisect_right, bisect_left
+from .utils import makedirs
+
+
+L = logging.getLogger(__name__)
+
+
+RECORD_HEADER = struct.Struct(">QI")
+SEGMENT_SUFFIX = ".seg"
+
+
+class _Segment:
+
+    __slots__ = ("path", "seq_nums", "offsets", "size")
+
+    def __init__(self, path):
+        self.path = path
+        self.seq_nums = array("Q")
+        self.offsets = array("Q")
+        # bytes of complete records, readers never go past this
+        self.size = 0
+
+
+class _TopicIndex:
+
+    __slots__ = ("path", "segments", "starts", "fd")
+
+    def __init__(self, path):
+        self.path = path
+        self.segments = []
+        # first seq_num of each segment, for bisecting
+        self.starts = []
+        # append handle of the last segment
+        self.fd = None
+
+
+def topic_to_dirname(topic: bytes):
+    if topic is None:
+        return "_"
+    return "t" + topic.hex()
+
+
+def dirname_to_topic(name: str):
+    if name == "_":
+        return None
+    return bytes.fromhex(name[1:])
+
+
+class Journal:
+
+    """Append-only message store.
+
+    Parameters
+    ----------
+    path : str
+        Directory where the journal lives. Existing segments are indexed on
+        construction.
+    max_segment_bytes : int
+        Segment size after which a new segment is started.
+    """
+
+    def __init__(self, path, max_segment_bytes=64_000_000):
+        self._path = path
+        self._max_segment_bytes = max_segment_bytes
+        self._topics = {}
+        # guards the index, appends and reads may happen on different threads
+        self._lock = threading.Lock()
+        makedirs(path)
+        self._load()
+
+
+    def _load(self):
+        for name in sorted(os.listdir(self._path)):
+            topic_path = os.path.join(self._path, name)
+            if not os.path.isdir(topic_path):
+                continue
+            try:
+                topic = dirname_to_topic(name)
+            except ValueError:
+                continue
+            index = _TopicIndex(topic_path)
+            for fn in sorted(os.listdir(topic_path)):
+                if not fn.endswith(SEGMENT_SUFFIX):
+                    continue
+                seg = self._index_segment(os.path.join(topic_path, fn))
+                if seg.seq_nums:
+                    index.segments.append(seg)
+                    index.starts.append(seg.seq_nums[0])
+            self._topics[topic] = index
+
+
+    def _index_segment(self, path):
+        seg = _Segment(path)
+        file_size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            offset = 0
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                seq_num, length = RECORD_HEADER.unpack(header)
+                f.seek(length, os.SEEK_CUR)
+                end = offset + RECORD_HEADER.size + length
+                if end > file_size:
+                    L.warning(f"truncated record in {path} at {offset}")
+                    break
+                seg.seq_nums.append(seq_num)
+                seg.offsets.append(offset)
+                offset = end
+            seg.size = offset
+        if seg.size < file_size:
+            # drop the partial record, appends must start at seg.size
+            L.warning(f"truncating {path} from {file_size} to {seg.size}")
+            os.truncate(path, seg.size)
+        return seg
+
+
+    def _get_index(self, topic):
+        index = self._topics.get(topic)
+        if index is None:
+            path = os.path.join(self._path, topic_to_dirname(topic))
+            makedirs(path)
+            index = _TopicIndex(path)
+            with self._lock:
+                self._topics[topic] = index
+        return index
+
+
+    def append(self, topic, records):
+        """Append records, an iterable of (seq_num, data) tuples."""
+        records = list(records)
+        if not records:
+            return
+        index = self._get_index(topic)
+        seg = index.segments[-1] if index.segments else None
+        if seg is None or seg.size >= self._max_segment_bytes:
+            if index.fd is not None:
+                index.fd.close()
+            fn = "{:020d}{}".format(records[0][0], SEGMENT_SUFFIX)
+            seg = _Segment(os.path.join(index.path, fn))
+            index.fd = open(seg.path, "ab")
+            with self._lock:
+                index.segments.append(seg)
+                index.starts.append(records[0][0])
+        elif index.fd is None:
+            index.fd = open(seg.path, "ab")
+        chunks = []
+        offset = seg.size
+        offsets = []
+        for seq_num, data in records:
+            chunks.append(RECORD_HEADER.pack(seq_num, len(data)))
+            chunks.append(data)
+            offsets.append(offset)
+            offset += RECORD_HEADER.size + len(data)
+        index.fd.write(b"".join(chunks))
+        index.fd.flush()
+        with self._lock:
+            seg.seq_nums.extend(x[0] for x in records)
+            seg.offsets.extend(offsets)
+            seg.size = offset
+
+
+    def first_seq(self, topic):
+        with self._lock:
+            index = self._topics.get(topic)
+            if not index or not index.segments:
+                return
+            return index.starts[0]
+
+
+    def last_seq(self, topic):
+        with self._lock:
+            index = self._topics.get(topic)
+            if not index or not index.segments:
+                return
+            return index.segments[-1].seq_nums[-1]
+
+
+    def _locate(self, index, seg_idx, start):
+        with self._lock:
+            if seg_idx >= len(index.segments):
+                return
+            seg = index.segments[seg_idx]
+            j = bisect_left(seg.seq_nums, start)
+            if j >= len(seg.seq_nums):
+                return seg.path, seg.size, seg.size
+            return seg.path, seg.offsets[j], seg.size
+
+
+    def read(self, topic, start, end=None):
+        """Generate (seq_num, data) for seq_nums in range [start, end]."""
+        with self._lock:
+            index = self._topics.get(topic)
+            if not index or not index.segments:
+                return
+            seg_idx = max(bisect_right(index.starts, start) - 1, 0)
+        while True:
+            located = self._locate(index, seg_idx, start)
+            if located is None:
+                return
+            path, pos, size = located
+            seg_idx += 1
+            if pos >= size:
+                continue
+            with open(path, "rb") as f:
+                f.seek(pos)
+                while pos < size:
+                    seq_num, length = RECORD_HEADER.unpack(
+                            f.read(RECORD_HEADER.size))
+                    if end is not None and seq_num > end:
+                        return
+                    yield seq_num, f.read(length)
+                    pos += RECORD_HEADER.size + length
+
+
+    def sync(self, topic=...):
+        """fsync the open segment of topic, or of all topics by default."""
+        if topic is ...:
+            indices = list(self._topics.values())
+        else:
+            indices = [self._topics[topic]]
+        for index in indices:
+            if index.fd is not None:
+                os.fsync(index.fd.fileno())
+
+
+    def close(self):
+        for index in self._topics.values():
+            if index.fd is not None:
+                index.fd.close()
+                index.fd = None
+
+
+###############################################################################
+
+
+class JournalWriter:
+
+    """Writes sealed message batches to a Journal on a background thread.
+
+    Parameters
+    ----------
+    journal : Journal
+    max_queue : int
+        Maximum number of batches waiting to be written. Callers check
+        `is_full` before sealing a batch, so that they keep the records
+        themselves while the writer is behind.
+    fsync : None, "always" or float
+        None never fsyncs, "always" fsyncs after every batch and a number
+        fsyncs once per that many seconds if anything was written.
+    """
+
+    def __init__(self, journal, max_queue=64, fsync=None):
+        if fsync not in (None, "always") and not fsync > 0:
+            raise ValueError(f"invalid fsync policy: {fsync}")
+        self._journal = journal
+        self._queue = queue.Queue(max_queue)
+        self._fsync = fsync
+        self._last_sync = time()
+        # written since last fsync
+        self._dirty = False
+        # batches that are queued or being written, per topic
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "batches_written": 0,
+            "records_written": 0,
+            "bytes_written": 0,
+            "write_errors": 0,
+            "queue_full": 0,
+            "max_queue_depth": 0,
+            "fsyncs": 0,
+            "last_write_s": 0.0,
+            "max_write_s": 0.0,
+            "total_write_s": 0.0,
+        }
+        self._thread = threading.Thread(
+                target=self._run, name="JournalWriter", daemon=True)
+        self._thread.start()
+
+
+    def is_full(self):
+        """Return True if the queue is full, counted in the queue_full
+        stat."""
+        if not self._queue.full():
+            return False
+        if not self._stats["queue_full"] % 1000:
+            L.warning("journal writer behind, {} batches queued"
+                      .format(self._queue.qsize()))
+        self._stats["queue_full"] += 1
+        return True
+
+
+    def put(self, topic, records, block=False):
+        """Queue a list of (seq_num, data) records for writing.
+
+        Raises queue.Full if the queue is full and block is False.
+        """
+        with self._lock:
+            pending = self._pending.setdefault(topic, deque())
+            pending.append(records)
+        try:
+            self._queue.put((topic, records), block)
+        except queue.Full:
+            with self._lock:
+                pending.pop()
+            raise
+        depth = self._queue.qsize()
+        if depth > self._stats["max_queue_depth"]:
+            self._stats["max_queue_depth"] = depth
+
+
+    def pending(self, topic):
+        """Return batches of topic that are not in the journal yet."""
+        with self._lock:
+            return list(self._pending.get(topic, ()))
+
+
+    def stats(self):
+        res = dict(self._stats)
+        res["queue_depth"] = self._queue.qsize()
+        n = res["batches_written"]
+        res["mean_write_s"] = res["total_write_s"] / n if n else 0.0
+        return res
+
+
+    def _write(self, topic, records):
+        t0 = time()
+        try:
+            self._journal.append(topic, records)
+            if self._fsync == "always":
+                self._journal.sync(topic)
+                self._stats["fsyncs"] += 1
+            elif self._fsync:
+                self._dirty = True
+                self._sync_due()
+        except Exception:
+            self._stats["write_errors"] += 1
+            L.exception("error writing to journal:")
+        else:
+            elapsed = time() - t0
+            self._stats["batches_written"] += 1
+            self._stats["records_written"] += len(records)
+            self._stats["bytes_written"] += sum(len(x[1]) for x in records)
+            self._stats["last_write_s"] = elapsed
+            self._stats["max_write_s"] = max(self._stats["max_write_s"],
+                                             elapsed)
+            self._stats["total_write_s"] += elapsed
+        with self._lock:
+            self._pending[topic].popleft()
+
+
+    def _sync_due(self):
+        now = time()
+        if self._dirty and now - self._last_sync >= self._fsync:
+            self._journal.sync()
+            self._last_sync = now
+            self._dirty = False
+            self._stats["fsyncs"] += 1
+
+
+    def _run(self):
+        timeout = None
+        if self._fsync not in (None, "always"):
+            timeout = self._fsync
+        while True:
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                # idle, sync the last batches written
+                try:
+                    self._sync_due()
+                except Exception:
+                    L.exception("error syncing journal:")
+                continue
+            if item is None:
+                break
+            self._write(*item)
+
+
+    def close(self):
+        """Write everything queued so far and stop the thread."""
+        if not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join()
+        if self._fsync:
+            self._journal.sync()
+        self._journal.close()
+
+
+###############################################################################
+
+
+class MessageRing:
+
+    """In-memory retention of the most recent encoded messages of a topic.
+
+    Records are stored in a circular list of slots that is reused as old
+    records are evicted. Seq nums are assumed to be contiguous, only the seq
+    num of the oldest record is stored.
+
+    Records are unsealed until `seal` returns them for journaling. Only sealed
+    records are evicted when the bytes budget runs out. The slot list grows
+    when all slots are taken and is reused from then on.
+    """
+
+    def __init__(self, max_bytes, num_slots=1024):
+        self._max_bytes = max_bytes
+        self._slots = [None] * num_slots
+        self._head = 0
+        self._count = 0
+        self._first_seq = None
+        self._bytes = 0
+        self._unsealed = 0
+        self.unsealed_bytes = 0
+
+
+    def __len__(self):
+        return self._count
+
+
+    @property
+    def first_seq(self):
+        return self._first_seq
+
+
+    @property
+    def last_seq(self):
+        if not self._count:
+            return
+        return self._first_seq + self._count - 1
+
+
+    def _evict_one(self):
+        slot = self._head
+        self._bytes -= len(self._slots[slot])
+        self._slots[slot] = None
+        self._head = (slot + 1) % len(self._slots)
+        self._count -= 1
+        self._first_seq += 1
+
+
+    def _grow(self):
+        n = len(self._slots)
+        ordered = [self._slots[(self._head + i) % n]
+                   for i in range(self._count)]
+        self._slots = ordered + [None] * (2 * n - self._count)
+        self._head = 0
+
+
+    def append(self, seq_num, data: bytes):
+        if self._count and seq_num != self._first_seq + self._count:
+            raise ValueError(
+                    f"non-contiguous seq_num: {seq_num}, "
+                    f"expected {self._first_seq + self._count}")
+        sealed = self._count - self._unsealed
+        while sealed and self._bytes + len(data) > self._max_bytes:
+            self._evict_one()
+            sealed -= 1
+        if self._count == len(self._slots):
+            self._grow()
+        if not self._count:
+            self._first_seq = seq_num
+        slot = (self._head + self._count) % len(self._slots)
+        self._slots[slot] = data
+        self._count += 1
+        self._bytes += len(data)
+        self._unsealed += 1
+        self.unsealed_bytes += len(data)
+
+
+    def get_range(self, start, end):
+        """Return (seq_num, data) records in range [start, end] that are
+        retained."""
+        if not self._count:
+            return []
+        start = max(start, self._first_seq)
+        end = min(end, self._first_seq + self._count - 1)
+        n = len(self._slots)
+        base = self._head - self._first_seq
+        return [(seq_num, self._slots[(base + seq_num) % n])
+                for seq_num in range(start, end + 1)]
+
+
+    def seal(self):
+        """Mark unsealed records sealed and return them."""
+        if not self._unsealed:
+            return []
+        res = self.get_range(self._first_seq + self._count - self._unsealed,
+                             self._first_seq + self._count - 1)
+        self._unsealed = 0
+        self.unsealed_bytes = 0
+        return res
@@ -1,13 +1,16 @@
 from .utils import get_timestamp, makedirs, check_if_error
+from .codec import get_codec, detect_codec, decode_msg
+from .codec import pack_batch, is_batch, unpack_batch
+from .journal import Journal, JournalWriter, MessageRing
 from .exceptions import *
-import pickle
 import os
 import shutil
-import re
-import copy
+import asyncio
+import zmq
 import logging
 import json
-from collections import defaultdict
+from asyncio import ensure_future as create_task
+from collections import defaultdict, deque
 from base64 import b64encode, b64decode
 from pprint import pprint, pformat
 
@@ -21,6 +24,25 @@ L = logging.getLogger(__name__)
 ###############################################################################
 
 
+def topic_key(topic):
+    """Normalize topic to the null terminated bytes used as state key."""
+    if topic is None:
+        return None
+    if type(topic) is str:
+        topic = topic.encode()
+    if topic[-1:] != b"\0":
+        topic += b"\0"
+    return topic
+
+
+###############################################################################
+
+
+# Republish rate of Publishers that may drop messages. PUB drops messages
+# beyond the HWM of a slow subscriber, so a republish has to leave time for
+# the queue to drain.
+DEFAULT_REPUBLISH_RATE = 10_000
+
 
 class Publisher:
 
@@ -29,49 +51,99 @@ class Publisher:
         self._sock = sock
         self._msg_cache_dir = kwargs.pop("msg_cache_dir", None)
         self._max_buffer_bytes = kwargs.pop("max_buffer_bytes", 10_000_000)
+        # encoded messages retained in memory per topic for fast resends
+        retention_bytes = kwargs.pop(
+                "retention_bytes", self._max_buffer_bytes)
+        retention_bytes = max(retention_bytes, self._max_buffer_bytes)
+        max_segment_bytes = kwargs.pop("max_segment_bytes", 64_000_000)
+        max_write_queue = kwargs.pop("max_write_queue", 64)
+        fsync = kwargs.pop("fsync", None)
+        # With nodrop sock must be an XPUB socket. Sends then wait for room
+        # instead of dropping messages, for live messages too.
+        nodrop = kwargs.pop("nodrop", False)
+        # republish pacing, messages per second
+        self._republish_rate = kwargs.pop(
+                "republish_rate", None if nodrop else DEFAULT_REPUBLISH_RATE)
+        self._republish_chunk_size = kwargs.pop("republish_chunk_size", None)
+        self._codec = get_codec(kwargs.pop("codec", None))
         if kwargs:
             raise ValueError(f"unsupported kwargs: {kwargs}")
+        if nodrop:
+            sock.setsockopt(zmq.XPUB_NODROP, 1)
+        # called with MsgType of every message published
+        self._listeners = []
         def create_empty_state():
             return {
                 "seq_num": 1,
-                "msg_buffer": [],
-                "buffer_bytes": 0,
+                "ring": MessageRing(retention_bytes),
             }
         self._state = defaultdict(create_empty_state)
+        self._republishing = {}
         if self._msg_cache_dir:
         #     try:
         #         shutil.rmtree(self._msg_cache_dir)
         #     except:
         #         pass
             os.makedirs(self._msg_cache_dir)
+            self._journal = Journal(self._msg_cache_dir,
+                                    max_segment_bytes=max_segment_bytes)
+            self._writer = JournalWriter(self._journal,
+                                         max_queue=max_write_queue,
+                                         fsync=fsync)
 
 
-    def _save_and_clear_msg_buffer(self, topic, state):
+    def _save_and_clear_msg_buffer(self, topic, state, block=False):
         if not self._msg_cache_dir:
             raise RuntimeError("message cache is disabled")
-        msg_buffer = state["msg_buffer"]
-        seq_num_start = msg_buffer[0][0]
-        seq_num_end = msg_buffer[-1][0]
-        topic_str = "" if topic is None else topic.strip(b"\0").decode()
-        fn = f"messages_({topic_str})_{seq_num_start}_{seq_num_end}.p"
-        fn = os.path.join(self._msg_cache_dir, fn)
-        with open(fn, "wb") as f:
-            pickle.dump(msg_buffer, f)
-        msg_buffer.clear()
-        state["buffer_bytes"] = 0
-
-
-    def _save_msg(self, state, seq_num, topic, msg, msg_bytes):
+        if not block and self._writer.is_full():
+            # keep the records unsealed in the ring, they are written as one
+            # batch once the writer catches up
+            return
+        # sealed records are written to disk by the writer thread
+        self._writer.put(topic, state["ring"].seal(), block)
+
+
+    def _save_msg(self, state, seq_num, topic, msg_bytes):
         if not self._msg_cache_dir:
             raise RuntimeError("message cache is disabled")
-        state["msg_buffer"].append((seq_num, msg))
-        # include only msg_bytes len in this calculation
-        state["buffer_bytes"] += len(msg_bytes)
-        # L.debug("buffer bytes: {}".format(self._buffer_bytes))
-        if state["buffer_bytes"] >= self._max_buffer_bytes:
+        ring = state["ring"]
+        ring.append(seq_num, msg_bytes)
+        if ring.unsealed_bytes >= self._max_buffer_bytes:
             self._save_and_clear_msg_buffer(topic, state)
 
 
+    def journal_stats(self):
+        """Return journal writer metrics such as queue depth and write
+        latency."""
+        if not self._msg_cache_dir:
+            raise RuntimeError("message cache is disabled")
+        return self._writer.stats()
+
+
+    def close(self):
+        """Flush buffered messages to the journal and stop the writer."""
+        if not self._msg_cache_dir:
+            return
+        for topic, state in self._state.items():
+            if state["ring"].unsealed_bytes:
+                self._save_and_clear_msg_buffer(topic, state, block=True)
+        self._writer.close()
+
+
+    def add_listener(self, f):
+        """Call f(msg_type) for every message published from now on."""
+        self._listeners.append(f)
+
+
+    def _notify_listeners(self, msg):
+        msg_type = msg["Header"].get("MsgType")
+        for f in self._listeners:
+            try:
+                f(msg_type)
+            except Exception:
+                L.exception("error in Publisher listener:")
+
+
     async def _send_msg(self, topic : bytes, msg : bytes):
         if topic is None:
             msg_parts = [msg]
@@ -80,59 +152,118 @@ class Publisher:
         await self._sock.send_multipart(msg_parts)
 
 
-    def fetch_messages(self, start, end, topic):
+    def _read_persisted(self, topic, start, end, ring_start):
+        # Take pending batches before reading the journal. A batch that gets
+        # written in between is then read from the pending snapshot only.
+        res = []
+        pending = self._writer.pending(topic)
+        journal_end = ring_start - 1
+        if pending:
+            journal_end = min(journal_end, pending[0][0][0] - 1)
+        if start <= journal_end:
+            first_seq = self._journal.first_seq(topic)
+            if first_seq is None or first_seq > start:
+                raise Exception("no matching data found from msg_cache_dir")
+            res += self._journal.read(topic, start, min(end, journal_end))
+        for records in pending:
+            for record in records:
+                if start <= record[0] <= end and record[0] < ring_start:
+                    res.append(record)
+        return res
+
+
+    def iter_messages(self, start, end, topic, chunk_size=1000):
+        """Generate lists of at most chunk_size (seq_num, msg_bytes) in range
+        [start, end].
+
+        end == 0 means up to the last message published when the generator
+        was created. Sources are looked up again for every chunk, so the
+        generator may be consumed across awaits while publishing goes on.
+        """
         if not self._msg_cache_dir:
             raise NotImplementedError("message cache is disabled")
         L.debug(f"fetch messages: {start} {end}")
-        state = self._state[topic.encode()]
-        msg_buffer = state["msg_buffer"]
-        if msg_buffer:
-            buffer_start = msg_buffer[0][0]
-            buffer_end = msg_buffer[-1][0]
-            if end == 0:
-                end = buffer_end
-            assert start >= 1, (start, end)
-            assert end >= start, (start, end)
-            assert end <= buffer_end, (end, buffer_end)
-            if start > buffer_start:
-                offset = buffer_start - start
-                res = msg_buffer[offset:offset+(end-start+1)]
-                return copy.deepcopy(res)
-        res = None
-        for x in os.listdir(self._msg_cache_dir):
-            fn = os.path.join(self._msg_cache_dir, x)
-            try:
-                r = re.match(r"(messages_\()(.*?)(\)_)(\d+)(_)(\d+)", x).groups()
-            except:
-                continue
-            f_topic = r[1]
-            if f_topic != topic:
-                continue
-            f_start = int(r[3])
-            f_end = int(r[5])
-            if f_start <= start <= f_end:
-                with open(fn, "rb") as f:
-                    res = pickle.load(f)
-                    break
-        if res is None:
-            raise Exception("no matching data found from msg_cache_dir")
-        if end <= f_end:
-            offset = start - f_start
-            return res[offset:offset+(end-start+1)]
-        res += self.fetch_messages(f_end + 1, end, topic)
+        topic = topic_key(topic)
+        state = self._state[topic]
+        ring = state["ring"]
+        if end == 0:
+            end = state["seq_num"] - 1
+        assert start >= 1, (start, end)
+        assert end >= start, (start, end)
+        assert end < state["seq_num"], (end, state["seq_num"])
+        while start <= end:
+            chunk_end = min(end, start + chunk_size - 1)
+            ring_start = ring.first_seq if len(ring) else state["seq_num"]
+            if start < ring_start:
+                chunk = self._read_persisted(
+                        topic, start, chunk_end, ring_start)
+                if chunk_end >= ring_start:
+                    chunk += ring.get_range(ring_start, chunk_end)
+            else:
+                chunk = ring.get_range(start, chunk_end)
+            yield chunk
+            start = chunk_end + 1
+
+
+    def fetch_messages(self, start, end, topic):
+        """Return list of (seq_num, msg_bytes) in range [start, end].
+
+        end == 0 means up to the last published message.
+        """
+        if end == 0:
+            chunk_size = self._state[topic_key(topic)]["seq_num"]
+        else:
+            chunk_size = end - start + 1
+        res = []
+        for chunk in self.iter_messages(start, end, topic, chunk_size):
+            res += chunk
         return res
 
 
     async def republish(self, start, end, topic, req_id):
+        """Republish range [start, end] of topic with PossDupFlag set.
+
+        The range is streamed from the message cache in chunks and paced
+        with republish_rate. With nodrop and no republish_rate the pace is
+        set by the sends, which wait while the socket is full. A newer
+        republish with the same req_id supersedes a running one, in which
+        case None is returned. Otherwise returns the number of messages
+        republished.
+        """
         if type(topic) is bytes:
             topic = topic.decode()
-        for _, msg in self.fetch_messages(start, end, topic):
-            msg["Header"]["PossDupFlag"] = True
-            msg["Body"]["ZMReqID"] = req_id
-            msg_bytes = (" " + json.dumps(msg)).encode()
-            pub_topic = req_id.encode() + b"\0" + topic.encode() + b"\0"
-            await self._send_msg(pub_topic, msg_bytes)
-            #await self._sock.send_multipart([pub_topic, msg_bytes])
+        token = object()
+        self._republishing[req_id] = token
+        header = {"PossDupFlag": True}
+        body = {"ZMReqID": req_id}
+        pub_topic = req_id.encode() + b"\0" + topic.encode() + b"\0"
+        chunk_size = self._republish_chunk_size
+        if chunk_size is None:
+            # stay well below the socket HWM between pauses
+            chunk_size = max(self._sock.get_hwm() // 2, 1)
+        loop = asyncio.get_event_loop()
+        t0 = loop.time()
+        count = 0
+        try:
+            for chunk in self.iter_messages(start, end, topic, chunk_size):
+                for _, data in chunk:
+                    msg_bytes = detect_codec(data, self._codec).patch(
+                            data, header, body)
+                    await self._send_msg(pub_topic, msg_bytes)
+                count += len(chunk)
+                if self._republish_rate:
+                    delay = t0 + count / self._republish_rate - loop.time()
+                else:
+                    delay = 0
+                await asyncio.sleep(max(delay, 0))
+                if self._republishing.get(req_id) is not token:
+                    L.info(f"republish {req_id} superseded after "
+                           f"{count} messages")
+                    return
+        finally:
+            if self._republishing.get(req_id) is token:
+                del self._republishing[req_id]
+        return count
 
 
     async def publish(
@@ -157,27 +288,229 @@ class Publisher:
         if not no_seq_num:
             msg["Header"]["MsgSeqNum"] = seq_num = state["seq_num"]
             state["seq_num"] += 1
-        msg_bytes = (" " + json.dumps(msg)).encode()
+        msg_bytes = self._codec.encode(msg)
         # if topic is None:
         #     msg_parts = [msg_bytes]
         # else:
         #     msg_parts = [topic, msg_bytes]
         if self._msg_cache_dir and not no_seq_num:
-            self._save_msg(state, seq_num, topic, msg, msg_bytes)
+            self._save_msg(state, seq_num, topic, msg_bytes)
         await self._send_msg(topic, msg_bytes)
         #await self._sock.send_multipart(msg_parts)
+        if self._listeners:
+            self._notify_listeners(msg)
         return msg["Header"].get("MsgSeqNum")
 
 
+    # mutates msgs
+    async def publish_many(self, msgs, topic: bytes = None):
+        """Publish messages in one batch frame.
+
+        The messages get a contiguous range of MsgSeqNums and share the same
+        ZMSendingTime unless they already have one. Returns MsgSeqNum of the
+        first message.
+        """
+        if not msgs:
+            return
+        if topic != None and topic[-1] != 0:
+            topic += b"\0"
+        timestamp = get_timestamp()
+        state = self._state[topic]
+        first_seq_num = seq_num = state["seq_num"]
+        state["seq_num"] += len(msgs)
+        encode = self._codec.encode
+        frames = []
+        for msg in msgs:
+            header = msg["Header"]
+            if "ZMSendingTime" not in header:
+                header["ZMSendingTime"] = timestamp
+            header["MsgSeqNum"] = seq_num
+            seq_num += 1
+            frames.append(encode(msg))
+        if self._msg_cache_dir:
+            for i, msg_bytes in enumerate(frames):
+                self._save_msg(state, first_seq_num + i, topic, msg_bytes)
+        await self._send_msg(topic, pack_batch(frames))
+        if self._listeners:
+            for msg in msgs:
+                self._notify_listeners(msg)
+        return first_seq_num
+
+
+###############################################################################
+
+
+class _GapRecovery:
+
+    """Fills a sequence gap of a Subscriber topic.
+
+    The gap is requested in chunks, several of them concurrently. Live
+    messages that arrive in the meantime are buffered. Recovered and buffered
+    messages are delivered strictly in sequence order as soon as they become
+    contiguous.
+
+    If the gap can't be filled within gap_fill_timeout, or more than
+    max_gap_buffer messages have to be buffered, the missing messages are
+    skipped. The same happens when a sequence reset shows up on the live
+    stream. Messages that arrive after recovery has been abandoned are
+    processed normally once the buffered ones have been delivered.
+    """
+
+    def __init__(self, sub, topic, start, end):
+        self._sub = sub
+        self._topic = topic
+        self._fill_end = end
+        self._next_seq = start
+        self._pending = {}
+        self._deferred = deque()
+        self._aborted = False
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self._plan(start)
+
+
+    def _plan(self, start):
+        sem = asyncio.Semaphore(self._sub._gap_fill_concurrency)
+        chunk_size = self._sub._gap_fill_chunk_size
+        for a in range(start, self._fill_end + 1, chunk_size):
+            b = min(a + chunk_size - 1, self._fill_end)
+            self._tasks.append(create_task(self._fetch(sem, a, b)))
+
+
+    async def _fetch(self, sem, start, end):
+        sub = self._sub
+        try:
+            async with sem:
+                session_id, msgs = await sub._req_gap_fill(
+                        start, end, self._topic, sub._gap_fill_timeout)
+            if session_id and session_id != sub._expected_session_id:
+                L.info(sub._tag + "session changed during gap, "
+                       "requesting gap fill from the beginning ...")
+                sub._expected_session_id = session_id
+                self._restart()
+                return
+            for msg in msgs:
+                seq_no = msg["Header"]["MsgSeqNum"]
+                if seq_no >= self._next_seq:
+                    self._pending.setdefault(seq_no, msg)
+        except Exception:
+            L.exception(sub._tag + f"error filling gap {start}-{end}:")
+        finally:
+            self._wakeup.set()
+
+
+    def _restart(self):
+        for task in self._tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        self._tasks = []
+        # results of the old session are useless, live messages are kept
+        self._pending = {k: v for k, v in self._pending.items()
+                         if k > self._fill_end}
+        self._next_seq = 1
+        self._plan(1)
+
+
+    def _abort(self, reason):
+        if not self._aborted:
+            L.warning(self._sub._tag + f"abandoning gap fill: {reason}")
+            self._aborted = True
+        self._wakeup.set()
+
+
+    def add_live(self, msg):
+        if self._aborted:
+            self._deferred.append(msg)
+            return
+        header = msg["Header"]
+        seq_no = header["MsgSeqNum"]
+        if seq_no < self._next_seq:
+            if header.get("PossDupFlag"):
+                return
+            self._deferred.append(msg)
+            self._abort("sequence reset")
+            return
+        if len(self._pending) >= self._sub._max_gap_buffer:
+            self._deferred.append(msg)
+            self._abort("buffer full")
+            return
+        self._pending[seq_no] = msg
+        self._wakeup.set()
+
+
+    async def _deliver(self, skip_missing=False):
+        pending = self._pending
+        while pending:
+            if self._next_seq not in pending:
+                if not skip_missing:
+                    return
+                seq_no = min(pending)
+                L.error(self._sub._tag + "messages lost: {}-{}"
+                        .format(self._next_seq, seq_no - 1))
+                self._next_seq = seq_no
+            msg = pending.pop(self._next_seq)
+            self._next_seq += 1
+            await self._sub._handle_msg_1(self._topic, msg)
+
+
+    async def run(self):
+        sub = self._sub
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + sub._gap_fill_timeout
+        try:
+            while not self._aborted:
+                self._wakeup.clear()
+                await self._deliver()
+                if all(t.done() for t in self._tasks):
+                    break
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    self._abort("timeout")
+                    break
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in self._tasks:
+                task.cancel()
+        await self._deliver(skip_missing=True)
+        state = sub._state[self._topic]
+        state["expected_seq_no"] = self._next_seq
+        # add_live defers everything from now on
+        self._aborted = True
+        while self._deferred:
+            msg = self._deferred.popleft()
+            if state["recovery"] is not self:
+                # a deferred message started a new recovery
+                state["recovery"].add_live(msg)
+                continue
+            await sub._process_msg(self._topic, msg, self)
+        if state["recovery"] is self:
+            state["recovery"] = None
+        L.info(sub._tag + "gap recovery finished")
+
+
 ###############################################################################
 
 
 class Subscriber:
 
 
-    def __init__(self, sock, dealer=None, name=None):
+    def __init__(self, sock, dealer=None, name=None, codec=None,
+                 batch_size=None, **kwargs):
         self._sock_sub = sock
         self._sock_dealer = dealer
+        self._codec = get_codec(codec)
+        # when set, run() drains up to batch_size queued frames at a time
+        self._batch_size = batch_size
+        # gap recovery settings
+        self._gap_fill_chunk_size = kwargs.pop("gap_fill_chunk_size", 10_000)
+        self._gap_fill_concurrency = kwargs.pop("gap_fill_concurrency", 4)
+        self._gap_fill_timeout = kwargs.pop("gap_fill_timeout", 60)
+        self._max_gap_buffer = kwargs.pop("max_gap_buffer", 100_000)
+        if kwargs:
+            raise ValueError(f"unsupported kwargs: {kwargs}")
         self._name = name
         if self._name:
             self._tag = "[" + self._name + "] "
@@ -185,7 +518,8 @@ class Subscriber:
             self._tag = ""
         def create_empty_state():
             return {
-                "expected_seq_no": None
+                "expected_seq_no": None,
+                "recovery": None,
             }
         self._state = defaultdict(create_empty_state)
         self._session_id = None
@@ -196,6 +530,15 @@ class Subscriber:
         raise NotImplementedError("_handle_msg_2 must be implemented")
 
 
+    async def _handle_batch(self, topic, msgs):
+        """Handle in-sequence messages of one topic received in a batch.
+
+        Override to process the messages in bulk.
+        """
+        for msg in msgs:
+            await self._handle_msg_1(topic, msg)
+
+
     async def _handle_msg_1(self, topic, msg):
         try:
             await self._handle_msg_2(topic, msg)
@@ -219,38 +562,46 @@ class Subscriber:
         if endpoint:
             header["ZMEndpoint"] = endpoint
         msg["Body"] = body
-        msg_bytes = (" " + json.dumps(msg)).encode()
+        msg_bytes = self._codec.encode(msg)
         msg_parts = await self._sock_dealer.send_recv_msg(
                 msg_bytes, ident=ident, timeout=timeout)
         if not msg_parts:
             return
-        msg = json.loads(msg_parts[-1].decode())
+        msg = decode_msg(msg_parts[-1], self._codec)
         if check_error:
             check_if_error(msg)
         return msg
 
 
-    async def _req_gap_fill(self, start, end, topic):
+    async def _req_gap_fill(self, start, end, topic, timeout=None):
+        """Request messages [start, end] of topic from upstream.
+
+        Returns (session_id, messages). timeout is in seconds.
+        """
         body = {}
         body["BeginSeqNo"] = start
         body["EndSeqNo"] = end
         body["ZMPubTopic"] = topic
-        res = await self._send_recv_command(
-                fix.MsgType.ResendRequest, body=body, check_error=True)
+        # messages come as raw frames before the response
+        body["ZMRawFrames"] = True
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+        msg = {"Header": {"MsgType": fix.MsgType.ResendRequest}, "Body": body}
+        msg_parts = await self._sock_dealer.send_recv_msg(
+                self._codec.encode(msg), timeout=timeout)
+        if not msg_parts:
+            raise TimeoutError(f"ResendRequest {start}-{end} timed out")
+        res = decode_msg(msg_parts[-1], self._codec)
+        check_if_error(res)
         body = res["Body"]
-        if body["ZMSessionID"] != self._expected_session_id:
-            L.info(self._tag + "session changed during gap, "
-                   "requesting gap fill from the beginning ...")
-            self._expected_session_id = body["ZMSessionID"]
-            return self._req_gap_fill(1, end)
-        messages = [json.loads(b64decode(x.encode()).decode())
-                    for x in body["ZMNoPubMessages"]]
-        # if "ZMNoSubscriberTopics" in body:
-        #     topics = [b64decode(x.encode()).decode()
-        #               for x in body["ZMNoSubscriberTopics"]]
-        # else:
-        #     topics = [None] * len(messages)
-        return messages
+        count = body.get("ZMPubMsgCount")
+        if count is not None:
+            frames = msg_parts[len(msg_parts) - 1 - count:-1]
+        else:
+            # upstream without raw frame support
+            frames = [b64decode(x.encode()) for x in body["ZMNoPubMessages"]]
+        messages = [decode_msg(x, self._codec) for x in frames]
+        return body.get("ZMSessionID"), messages
 
 
     async def _get_session_id(self):
@@ -259,24 +610,101 @@ class Subscriber:
         return res["Body"]["ZMSessionID"]
 
 
-    async def handle_one(self):
+    async def _check_session_id(self):
         if self._expected_session_id is None:
             self._expected_session_id = await self._get_session_id()
             L.debug(self._tag + "upstream session id: {}"
                     .format(self._expected_session_id))
+
+
+    async def handle_one(self):
+        await self._check_session_id()
         msg_parts = await self._sock_sub.recv_multipart()
-        # message must be the last part of the message
-        msg = json.loads(msg_parts[-1].decode())
         topic = None
         if len(msg_parts) > 1:
             # topic must be the second last part of the message
             topic = msg_parts[-2].strip(b"\0").decode()
+        # message must be the last part of the message
+        data = msg_parts[-1]
+        if is_batch(data):
+            for frame in unpack_batch(data):
+                await self._process_msg(topic, decode_msg(frame, self._codec))
+        else:
+            await self._process_msg(topic, decode_msg(data, self._codec))
+
+
+    async def handle_batch(self):
+        """Wait for a message and drain up to batch_size queued frames
+        without blocking.
+
+        Messages are grouped by topic. Runs of a topic that continue the
+        expected sequence without gaps are passed to _handle_batch at once,
+        anything else goes through the per-message path. Relative order of
+        messages of different topics is not preserved.
+        """
+        await self._check_session_id()
+        sock = self._sock_sub
+        batch = [await sock.recv_multipart()]
+        while len(batch) < self._batch_size:
+            try:
+                batch.append(await sock.recv_multipart(zmq.NOBLOCK))
+            except zmq.Again:
+                break
+        topics = {}
+        by_topic = {}
+        codec = self._codec
+        for msg_parts in batch:
+            topic = None
+            if len(msg_parts) > 1:
+                raw_topic = msg_parts[-2]
+                topic = topics.get(raw_topic)
+                if topic is None:
+                    topic = raw_topic.strip(b"\0").decode()
+                    topics[raw_topic] = topic
+            msgs = by_topic.get(topic)
+            if msgs is None:
+                msgs = by_topic[topic] = []
+            data = msg_parts[-1]
+            if is_batch(data):
+                msgs.extend(decode_msg(x, codec) for x in unpack_batch(data))
+            else:
+                msgs.append(decode_msg(data, codec))
+        for topic, msgs in by_topic.items():
+            state = self._state[topic]
+            seq_nos = [msg["Header"].get("MsgSeqNum") for msg in msgs]
+            expected = state["expected_seq_no"]
+            if expected is None:
+                expected = seq_nos[0]
+            in_sequence = (state["recovery"] is None and
+                           seq_nos[0] == expected and
+                           None not in seq_nos)
+            if in_sequence:
+                for a, b in zip(seq_nos, seq_nos[1:]):
+                    if b - a != 1:
+                        in_sequence = False
+                        break
+            if in_sequence:
+                state["expected_seq_no"] = seq_nos[-1] + 1
+                try:
+                    await self._handle_batch(topic, msgs)
+                except Exception:
+                    L.exception("error in Subscriber._handle_batch:")
+            else:
+                for msg in msgs:
+                    await self._process_msg(topic, msg)
+
+
+    async def _process_msg(self, topic, msg, recovery=None):
         state = self._state[topic]
         header = msg["Header"]
         seq_no = header.get("MsgSeqNum")
         if seq_no is None:
             await self._handle_msg_1(topic, msg)
             return
+        if state["recovery"] is not None and state["recovery"] is not recovery:
+            # gap recovery in progress, it delivers messages in order
+            state["recovery"].add_live(msg)
+            return
         if state["expected_seq_no"] is None:
             state["expected_seq_no"] = seq_no
         if seq_no == state["expected_seq_no"]:
@@ -296,23 +724,23 @@ class Subscriber:
         assert seq_no > state["expected_seq_no"], locals()
         start = state["expected_seq_no"]
         end = seq_no - 1
-        state["expected_seq_no"] = seq_no + 1
         L.warning("{}gap detected: {}-{}".format(self._tag, start, end))
-        if self._session_id:
-            self.info(self._tag + "requesting gap fill ...")
-            try:
-                messages = await self._req_gap_fill(
-                        start, end, topic)
-            except Exception:
-                L.error("error on Subscriber._req_gap_fill:")
-            else:
-                for t, m in zip(topics, messages):
-                    await self._handle_msg_1(t, m)
-        await self._handle_msg_1(topic, msg)
+        if self._sock_dealer is None:
+            state["expected_seq_no"] = seq_no + 1
+            await self._handle_msg_1(topic, msg)
+            return
+        L.info(self._tag + "requesting gap fill ...")
+        recovery = _GapRecovery(self, topic, start, end)
+        recovery.add_live(msg)
+        state["recovery"] = recovery
+        create_task(recovery.run())
 
 
     async def run(self):
         L.debug(self._tag + "running ...")
+        if self._batch_size:
+            while True:
+                await self.handle_batch()
         while True:
             await self.handle_one()
 
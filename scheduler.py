@@ -0,0 +1,158 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from zmapi import fix
+
+
+L = logging.getLogger(__name__)
+
+
+# Cheap requests that must not wait behind slow ones.
+DEFAULT_PRIORITIES = {
+    fix.MsgType.Heartbeat: 0,
+    fix.MsgType.TestRequest: 0,
+    fix.MsgType.ZMGetSessionID: 0,
+    fix.MsgType.ZMListCapabilities: 0,
+    fix.MsgType.ZMGetConnectorFeatures: 0,
+    fix.MsgType.ZMGetInstrumentFields: 0,
+    fix.MsgType.ZMListEndpoints: 0,
+}
+
+
+class RequestScheduler:
+
+    """Bounded request queue with priority classes and per-client fairness.
+
+    Requests are queued per priority class and within a class per client.
+    Workers always serve the highest non-empty priority class (0 is the
+    highest) and serve clients of a class in round-robin order, so that a
+    single client can't monopolize the workers.
+
+    Admission is bounded per client as well, so that a client flooding the
+    queue only gets its own requests refused, and part of the queue can be
+    reserved for the higher priority classes.
+
+    Parameters
+    ----------
+    max_concurrency : int
+        Number of requests handled concurrently.
+    max_queue : int
+        Maximum number of queued requests. `submit` refuses requests beyond
+        this.
+    priorities : dict
+        MsgType -> priority class. Defaults to DEFAULT_PRIORITIES.
+    default_priority : int
+        Priority class of MsgTypes missing from `priorities`.
+    max_queue_per_client : int
+        Maximum number of queued requests of a single client. Defaults to a
+        tenth of `max_queue`.
+    reserved : dict
+        Priority class -> number of queue slots kept for that class and the
+        classes above it. Defaults to a tenth of `max_queue` for class 0.
+    """
+
+    def __init__(self, max_concurrency=64, max_queue=10_000,
+                 priorities=None, default_priority=1,
+                 max_queue_per_client=None, reserved=None):
+        if priorities is None:
+            priorities = DEFAULT_PRIORITIES
+        self._max_concurrency = max_concurrency
+        self._max_queue = max_queue
+        if max_queue_per_client is None:
+            max_queue_per_client = max(max_queue // 10, 1)
+        self._max_queue_per_client = max_queue_per_client
+        if reserved is None:
+            reserved = {0: max_queue // 10}
+        self._priorities = priorities
+        self._default_priority = default_priority
+        num_classes = max(list(priorities.values()) + [default_priority]) + 1
+        # queue slots that must remain free after admitting to each class
+        self._headroom = [sum(reserved.get(i, 0) for i in range(prio))
+                          for prio in range(num_classes)]
+        if self._headroom[-1] >= max_queue:
+            raise ValueError("reserved slots leave none for lowest class")
+        # client key -> number of its queued requests
+        self._client_depth = {}
+        # per class: client key -> deque of items, in round-robin order
+        self._classes = [OrderedDict() for _ in range(num_classes)]
+        self._class_depth = [0] * num_classes
+        self._items = asyncio.Semaphore(0)
+        self._depth = 0
+        self._running = 0
+        self._stats = {
+            "submitted": 0,
+            "rejected": 0,
+            "completed": 0,
+            "max_depth": 0,
+        }
+
+
+    def submit(self, client, msg_type, item):
+        """Queue item of client. Returns False if the queue is full for
+        client or the priority class of msg_type."""
+        prio = self._priorities.get(msg_type, self._default_priority)
+        client_depth = self._client_depth.get(client, 0)
+        if self._depth >= self._max_queue - self._headroom[prio] or \
+                client_depth >= self._max_queue_per_client:
+            self._stats["rejected"] += 1
+            return False
+        self._client_depth[client] = client_depth + 1
+        queues = self._classes[prio]
+        q = queues.get(client)
+        if q is None:
+            q = queues[client] = deque()
+        q.append(item)
+        self._class_depth[prio] += 1
+        self._depth += 1
+        self._stats["submitted"] += 1
+        if self._depth > self._stats["max_depth"]:
+            self._stats["max_depth"] = self._depth
+        self._items.release()
+        return True
+
+
+    def _pop(self):
+        for prio, queues in enumerate(self._classes):
+            if not queues:
+                continue
+            client, q = next(iter(queues.items()))
+            item = q.popleft()
+            if self._client_depth[client] == 1:
+                del self._client_depth[client]
+            else:
+                self._client_depth[client] -= 1
+            if q:
+                queues.move_to_end(client)
+            else:
+                del queues[client]
+            self._class_depth[prio] -= 1
+            self._depth -= 1
+            return item
+
+
+    def stats(self):
+        res = dict(self._stats)
+        res["depth"] = self._depth
+        res["class_depth"] = list(self._class_depth)
+        res["running"] = self._running
+        return res
+
+
+    async def _worker(self, handler):
+        while True:
+            await self._items.acquire()
+            item = self._pop()
+            self._running += 1
+            try:
+                await handler(*item)
+            except Exception:
+                L.exception("error in RequestScheduler handler:")
+            finally:
+                self._running -= 1
+                self._stats["completed"] += 1
+
+
+    async def run(self, handler):
+        """Serve queued items by awaiting handler(*item)."""
+        await asyncio.gather(*[self._worker(handler)
+                               for _ in range(self._max_concurrency)])
@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiohttp")
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from zmapi.controller import RESTConnectorCTL
+
+
+class _Server:
+
+    """Local http server recording the connections requests come from."""
+
+    def __init__(self, delay_s=0):
+        self.delay_s = delay_s
+        self.peers = set()
+        self.active = 0
+        self.max_active = 0
+        self.not_modified = 0
+        app = web.Application()
+        app.router.add_get("/data", self._handle_data)
+        app.router.add_get("/etag", self._handle_etag)
+        self.server = TestServer(app)
+
+    async def _handle_data(self, request):
+        self.peers.add(request.transport.get_extra_info("peername"))
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay_s)
+        finally:
+            self.active -= 1
+        return web.Response(body=b"data")
+
+    async def _handle_etag(self, request):
+        self.peers.add(request.transport.get_extra_info("peername"))
+        if request.headers.get("If-None-Match") == '"v1"':
+            self.not_modified += 1
+            return web.Response(status=304)
+        return web.Response(body=b"etag", headers={"ETag": '"v1"'})
+
+    def url(self, path):
+        return str(self.server.make_url(path))
+
+
+async def _serve(test, delay_s=0, **kwargs):
+    srv = _Server(delay_s)
+    await srv.server.start_server()
+    ctl = RESTConnectorCTL(None, None, "ep", **kwargs)
+    try:
+        await test(srv, ctl)
+    finally:
+        await ctl.close()
+        await srv.server.close()
+
+
+def test_sequential_requests_reuse_connection():
+    async def test(srv, ctl):
+        for _ in range(20):
+            assert await ctl._http_get(srv.url("/data")) == b"data"
+        assert len(srv.peers) == 1
+    asyncio.run(_serve(test))
+
+
+def test_limit_per_host():
+    async def test(srv, ctl):
+        url = srv.url("/data")
+        # distinct urls, so that the fetches are not coalesced
+        res = await asyncio.gather(*[ctl._http_get(url + "?i={}".format(i))
+                                     for i in range(10)])
+        assert res == [b"data"] * 10
+        assert srv.max_active == 2
+        assert len(srv.peers) == 2
+    asyncio.run(_serve(test, delay_s=0.05, http_limit_per_host=2))
+
+
+def test_not_modified_is_accepted(tmp_path):
+    async def test(srv, ctl):
+        url = srv.url("/etag")
+        for _ in range(5):
+            res = await ctl._http_get_cached(url, expiration_s=0,
+                                             allow_stale=False)
+            assert res == b"etag"
+        assert srv.not_modified == 4
+        assert ctl.http_stats()["not_modified"] == 4
+        assert len(srv.peers) == 1
+    asyncio.run(_serve(test, http_disk_cache=str(tmp_path)))
+
+
+def test_timeout():
+    async def test(srv, ctl):
+        with pytest.raises(asyncio.TimeoutError):
+            await ctl._http_get(srv.url("/data"))
+    asyncio.run(_serve(test, delay_s=1, http_timeout_s=0.2))
+
+
+def test_reopen_after_close():
+    async def test(srv, ctl):
+        assert await ctl._http_get(srv.url("/data")) == b"data"
+        session = ctl._get_http_session()
+        await ctl.close()
+        assert session.closed
+        assert await ctl._http_get(srv.url("/data")) == b"data"
+        assert ctl._get_http_session() is not session
+        assert len(srv.peers) == 2
+    asyncio.run(_serve(test))
@@ -15,6 +15,7 @@ from collections import OrderedDict
 from functools import wraps
 from zmapi.exceptions import *
 from zmapi import fix
+from zmapi.codec import get_codec, decode_msg
 
 def check_missing(fields, d):
     if type(fields) is str:
@@ -75,16 +76,23 @@ def check_if_error(msg):
 
 
 async def send_recv_command_raw(sock, msg_type, **kwargs):
+    """Send a command on sock and wait for its reply, discarding any other
+    messages received meanwhile. timeout is in milliseconds.
+
+    Only one request may be in flight on sock at a time, use
+    zmapi.zmq.RequestClient for concurrent requests.
+    """
     body = kwargs.get("body", None)
     timeout = kwargs.get("timeout", None)
     endpoint = kwargs.get("endpoint", None)
+    codec = get_codec(kwargs.get("codec", None))
     msg = {}
     msg["Header"] = header = {}
     header["MsgType"] = msg_type
     if endpoint:
         header["ZMEndpoint"] = endpoint
     msg["Body"] = body if body is not None else {}
-    msg_bytes = (" " + json.dumps(msg)).encode()
+    msg_bytes = codec.encode(msg)
     msg_id_in = str(uuid4()).encode()
     await sock.send_multipart([b"", msg_id_in, msg_bytes])
     poller = zmq.asyncio.Poller()
@@ -95,15 +103,16 @@ async def send_recv_command_raw(sock, msg_type, **kwargs):
         if timeout is None:
             res = await poller.poll(timeout)
         else:
-            remaining_ms = timeout - (time() - start_time)
+            remaining_ms = timeout - (time() - start_time) * 1000
             res = await poller.poll(remaining_ms)
         if not res:
             return
         msg_parts = await sock.recv_multipart()
-        if msg_parts[-2] == msg_id_in:
+        # msg_id follows the delimiter, raw frames may precede the reply
+        if msg_parts[msg_parts.index(b"") + 1] == msg_id_in:
             msg = msg_parts[-1]
             break
-    msg = json.loads(msg.decode())
+    msg = decode_msg(msg, codec)
     check_if_error(msg)
     return msg
 
@@ -1 +1,2 @@
-from .core import ReturningDealer
+from .core import ReturningDealer, RequestClient
+from .throttler import ThrottlerService, RemoteThrottler
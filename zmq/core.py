@@ -1,8 +1,13 @@
 import zmq
 import zmq.asyncio
+import asyncio
 import json
 import logging
+from asyncio import ensure_future as create_task
 from uuid import uuid4
+from zmapi.codec import get_codec, decode_msg
+from zmapi.utils import check_if_error
+from .utils import get_msg_id
 
 
 L = logging.getLogger(__name__)
@@ -10,14 +15,19 @@ L = logging.getLogger(__name__)
 
 class ReturningDealer:
 
+    """Wrapper around a DEALER socket that returns replies to the awaiting
+    senders.
+
+    Replies are correlated with requests by msg_id. `run` must be running
+    for `send_recv_msg` to ever return anything: it resolves the future
+    registered for each msg_id in the pending table.
+    """
+
 
     def __init__(self, ctx, sock_dealer):
         self._ctx = ctx
         self._sock_dealer = sock_dealer
-        self._pub_addr = "inproc://ReturningDealer" + str(uuid4())
-        self._sock_pub = self._ctx.socket(zmq.PUB)
-        self._sock_pub.bind(self._pub_addr)
-        self._sub_socks = set()
+        self._pending = {}
         self._msg_id = 0
         self.running = False
 
@@ -29,41 +39,51 @@ class ReturningDealer:
     def close(self):
         self.running = False
         self._sock_dealer.close()
-        self._sock_pub.close()
-        for sock in self._sub_socks:
-            sock.close()
+        for fut in self._pending.values():
+            if not fut.done():
+                fut.cancel()
+        self._pending.clear()
 
 
     async def run(self):
         if self.running:
             raise RuntimeError("already running")
         self.running = True
-        L.debug("ReturningDealer running: {}".format(self._pub_addr))
+        L.debug("ReturningDealer running ...")
         while self.running:
             msg_parts = await self._sock_dealer.recv_multipart()
-            msg_id = msg_parts[-2]
-            self._sock_pub.send_multipart([msg_id + b"\0"] + msg_parts)
-        self._sock_pub.close()
+            try:
+                # replies may carry raw frames between msg_id and message
+                msg_id = get_msg_id(msg_parts)
+            except (ValueError, IndexError):
+                L.warning("dropped malformed reply")
+                continue
+            fut = self._pending.pop(msg_id, None)
+            if fut is None:
+                # timed out or cancelled already
+                L.debug("dropped reply to unknown msg_id: {}".format(msg_id))
+                continue
+            if not fut.done():
+                fut.set_result(msg_parts)
 
 
     async def poll_for_msg_id(self, msg_id, timeout=None):
-        sock = self._ctx.socket(zmq.SUB)
-        self._sub_socks.add(sock)
-        sock.connect(self._pub_addr)
-        sock.subscribe(msg_id + b"\0")
-        poller = zmq.asyncio.Poller()
-        poller.register(sock, zmq.POLLIN)
-        # racing conditions possible here with the destructor?
-        res = await poller.poll(timeout)
-        if not res:
-            sock.close()
-            self._sub_socks.remove(sock)
+        """Wait for the reply registered under msg_id.
+
+        timeout is in milliseconds. Returns None on timeout.
+        """
+        fut = self._pending.get(msg_id)
+        if fut is None:
+            raise KeyError("msg_id not registered: {}".format(msg_id))
+        try:
+            if timeout is None:
+                return await fut
+            return await asyncio.wait_for(fut, timeout / 1000)
+        except asyncio.TimeoutError:
             return
-        msg_parts = await sock.recv_multipart()
-        sock.close()
-        self._sub_socks.remove(sock)
-        # drop the topic
-        return msg_parts[1:]
+        finally:
+            # covers timeouts and cancellation of the awaiting task
+            self._pending.pop(msg_id, None)
 
 
     def _gen_msg_id(self):
@@ -74,10 +94,17 @@ class ReturningDealer:
 
     async def send_recv_msg(self, msg : bytes, timeout=None, ident=None):
         msg_id = self._gen_msg_id()
-        if ident:
-            await self._sock_dealer.send_multipart(ident + [b"", msg_id, msg])
-        else:
-            await self._sock_dealer.send_multipart([b"", msg_id, msg])
+        # register before sending so that the reply can't be missed
+        self._pending[msg_id] = asyncio.get_event_loop().create_future()
+        try:
+            if ident:
+                await self._sock_dealer.send_multipart(
+                        ident + [b"", msg_id, msg])
+            else:
+                await self._sock_dealer.send_multipart([b"", msg_id, msg])
+        except BaseException:
+            self._pending.pop(msg_id, None)
+            raise
         return await self.poll_for_msg_id(msg_id, timeout)
 
 
@@ -86,3 +113,164 @@ class ReturningDealer:
     #     self.running = False
     #     msg = (" " + json.dumps(data)).encode()
     #     await self.send_recv_msg(msg, timeout)
+
+
+###############################################################################
+
+
+class RequestClient:
+
+    """Client that sends requests to a Controller over DEALER sockets it
+    owns.
+
+    Replies are correlated with requests by msg_id, so any number of
+    requests may be in flight concurrently. Requests are spread over
+    num_sockets sockets in round-robin order.
+
+    The sockets are recreated by `reconnect`, which is also done
+    automatically after max_timeouts consecutive timeouts. Requests in
+    flight then fail with ConnectionError.
+
+    Parameters
+    ----------
+    ctx : zmq.asyncio.Context
+    addr : str
+        Address of the Controller's ROUTER socket.
+    num_sockets : int
+    codec : str or Codec
+        Codec used to encode the requests, defaults to the default codec.
+    max_timeouts : int
+        Consecutive timeouts after which to reconnect, None to never.
+    """
+
+
+    def __init__(self, ctx, addr, num_sockets=1, codec=None, max_timeouts=3):
+        self._ctx = ctx
+        self._addr = addr
+        self._num_sockets = num_sockets
+        self._codec = get_codec(codec)
+        self._max_timeouts = max_timeouts
+        self._socks = []
+        self._recv_tasks = []
+        self._pending = {}
+        # unique per client, replies meant for others are never matched
+        self._msg_id_prefix = uuid4().hex[:8] + "-"
+        self._msg_id = 0
+        self._next_sock = 0
+        self._num_timeouts = 0
+
+
+    def __del__(self):
+        self.close()
+
+
+    def _connect(self):
+        for _ in range(self._num_sockets):
+            sock = self._ctx.socket(zmq.DEALER)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.connect(self._addr)
+            self._socks.append(sock)
+            self._recv_tasks.append(create_task(self._recv_loop(sock)))
+
+
+    def _disconnect(self, exc):
+        for task in self._recv_tasks:
+            task.cancel()
+        self._recv_tasks = []
+        for sock in self._socks:
+            sock.close()
+        self._socks = []
+        for fut in self._pending.values():
+            if not fut.done():
+                fut.set_exception(exc)
+        self._pending.clear()
+
+
+    def reconnect(self):
+        """Recreate the sockets, failing the requests in flight."""
+        L.info("RequestClient reconnecting to {} ...".format(self._addr))
+        self._disconnect(ConnectionError("reconnected"))
+        self._num_timeouts = 0
+        self._connect()
+
+
+    def close(self):
+        self._disconnect(ConnectionError("closed"))
+
+
+    async def _recv_loop(self, sock):
+        while True:
+            msg_parts = await sock.recv_multipart()
+            try:
+                msg_id = get_msg_id(msg_parts)
+            except (ValueError, IndexError):
+                L.warning("RequestClient dropped malformed reply")
+                continue
+            fut = self._pending.pop(msg_id, None)
+            if fut is None:
+                L.debug("dropped reply to unknown msg_id: {}".format(msg_id))
+                continue
+            if not fut.done():
+                fut.set_result(msg_parts)
+
+
+    def _gen_msg_id(self):
+        msg_id = (self._msg_id_prefix + str(self._msg_id)).encode()
+        self._msg_id += 1
+        return msg_id
+
+
+    async def send_recv_msg(self, msg : bytes, timeout=None):
+        """Send encoded msg and return the reply parts.
+
+        timeout is in milliseconds. Returns None on timeout.
+        """
+        if not self._socks:
+            self._connect()
+        sock = self._socks[self._next_sock]
+        self._next_sock = (self._next_sock + 1) % len(self._socks)
+        msg_id = self._gen_msg_id()
+        fut = asyncio.get_event_loop().create_future()
+        self._pending[msg_id] = fut
+        try:
+            await sock.send_multipart([b"", msg_id, msg])
+            if timeout is None:
+                res = await fut
+            else:
+                res = await asyncio.wait_for(fut, timeout / 1000)
+        except asyncio.TimeoutError:
+            self._num_timeouts += 1
+            if self._max_timeouts \
+                    and self._num_timeouts >= self._max_timeouts:
+                self.reconnect()
+            return
+        finally:
+            self._pending.pop(msg_id, None)
+        self._num_timeouts = 0
+        return res
+
+
+    async def send_recv_command(self, msg_type, **kwargs):
+        """Send command of msg_type and return the decoded reply.
+
+        Takes body, endpoint, timeout (ms) and check_error (default True)
+        kwargs. Returns None on timeout.
+        """
+        body = kwargs.pop("body", None)
+        endpoint = kwargs.pop("endpoint", None)
+        timeout = kwargs.pop("timeout", None)
+        check_error = kwargs.pop("check_error", True)
+        msg = {}
+        msg["Header"] = header = {}
+        header["MsgType"] = msg_type
+        if endpoint:
+            header["ZMEndpoint"] = endpoint
+        msg["Body"] = body if body is not None else {}
+        msg_parts = await self.send_recv_msg(self._codec.encode(msg),
+                                             timeout)
+        if not msg_parts:
+            return
+        msg = decode_msg(msg_parts[-1], self._codec)
+        if check_error:
+            check_if_error(msg)
+        return msg
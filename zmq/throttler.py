@@ -0,0 +1,120 @@
+"""Throttling budgets shared between processes.
+
+A ThrottlerService owns the Throttlers and grants runs to RemoteThrottlers
+of any process connected to it, so that all of them draw from a single
+budget. A grant costs one request-reply round trip over a local socket.
+"""
+
+import asyncio
+import json
+import logging
+from time import time
+from asyncio import ensure_future as create_task
+from zmapi.asyncio import PRIORITY_NORMAL
+from .utils import split_message
+
+
+L = logging.getLogger(__name__)
+
+
+class ThrottlerService:
+
+    """Grants runs of named Throttlers to remote callers.
+
+    Each request is waited on in its own task, so one throttled caller
+    doesn't hold up the others. The Throttlers may have a pub_sock to publish
+    their sleeps as usual.
+
+    Parameters
+    ----------
+    sock_router : zmq.asyncio.Socket
+        ROUTER socket the RemoteThrottlers connect to.
+    throttlers : dict
+        name -> Throttler.
+    """
+
+
+    def __init__(self, sock_router, throttlers=None):
+        self._sock = sock_router
+        self._throttlers = dict(throttlers or {})
+
+
+    def add_throttler(self, name, throttler):
+        self._throttlers[name] = throttler
+
+
+    async def _handle(self, ident, msg_id, msg):
+        try:
+            req = json.loads(msg.decode())
+            throttler = self._throttlers.get(req["name"])
+            if throttler is None:
+                res = {"Error": "unknown throttler: {}".format(req["name"])}
+            else:
+                priority = req.get("priority", PRIORITY_NORMAL)
+                deadline = req.get("deadline")
+                if deadline is None:
+                    await throttler(priority)
+                else:
+                    # don't take a run the caller has stopped waiting for
+                    await asyncio.wait_for(throttler(priority),
+                                           max(deadline - time(), 0))
+                res = {}
+        except asyncio.TimeoutError:
+            L.debug("throttler request {} expired".format(msg_id))
+            res = {"Error": "expired"}
+        except Exception as err:
+            L.exception("error handling throttler request:")
+            res = {"Error": str(err)}
+        await self._sock.send_multipart(
+                ident + [b"", msg_id, json.dumps(res).encode()])
+
+
+    async def run(self):
+        L.debug("ThrottlerService running ...")
+        while True:
+            msg_parts = await self._sock.recv_multipart()
+            try:
+                ident, (msg_id, msg) = split_message(msg_parts)
+            except ValueError:
+                L.warning("malformed throttler request dropped")
+                continue
+            create_task(self._handle(ident, msg_id, msg))
+
+
+class RemoteThrottler:
+
+    """Drop-in replacement for Throttler that draws from a budget of a
+    ThrottlerService.
+
+    Parameters
+    ----------
+    dealer : ReturningDealer
+        Dealer connected to the service, may be shared by many
+        RemoteThrottlers. Its `run` must be running.
+    name : str
+        Name of the throttler at the service.
+    timeout : int
+        Milliseconds to wait for a grant, None to wait indefinitely. The
+        service drops requests that are not granted in time.
+    """
+
+
+    def __init__(self, dealer, name, timeout=None):
+        self._dealer = dealer
+        self._name = name
+        self._timeout = timeout
+
+
+    async def __call__(self, priority=PRIORITY_NORMAL):
+        req = {"name": self._name, "priority": priority}
+        if self._timeout is not None:
+            # both ends are on the same host, wall clock is shared
+            req["deadline"] = time() + self._timeout / 1000
+        msg = json.dumps(req).encode()
+        msg_parts = await self._dealer.send_recv_msg(msg, self._timeout)
+        if msg_parts is None:
+            raise asyncio.TimeoutError(
+                    "no grant from throttler service for " + self._name)
+        res = json.loads(msg_parts[-1].decode())
+        if "Error" in res:
+            raise RuntimeError(res["Error"])
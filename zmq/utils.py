@@ -12,6 +12,16 @@ def split_message(msg_parts):
     rest = msg_parts[separator_idx+1:]
     return ident, rest
 
+def get_msg_id(msg_parts):
+    """Return msg_id of a reply received on a DEALER socket, the frame
+    after the first empty delimiter."""
+    return msg_parts[msg_parts.index(b"") + 1]
+
+def get_reply_frames(msg_parts):
+    """Return frames of a reply received on a DEALER socket that follow the
+    msg_id, the reply message being the last one."""
+    return msg_parts[msg_parts.index(b"") + 2:]
+
 def ident_to_str(ident):
     # "latin-1" decoding never throws exceptions on python on any input so 
     # something printable will always come out as a result...